@@ -0,0 +1,80 @@
+"""
+Benchmark of the Interfile header parsers.
+
+Compares the line by line `LineParser` loop that `FileParser` used before
+against the single pass `parse_header_string`, and the cached
+`parse_many` on repeated parsing of the same headers.
+
+Run with ``python examples/benchmark_interfile.py [number of copies]``.
+"""
+
+import os
+import shutil
+import sys
+import tempfile
+import time
+from io import StringIO
+from pathlib import Path
+
+from odlpet.utils.interfile import (LineParser, parse_header_string, parse_many,
+                                    clear_header_cache)
+
+
+def legacy_parse_string(header_string):
+    result = {}
+    line_parser = LineParser()
+    fid = StringIO()
+    fid.write(header_string)
+    fid.seek(0)
+    for line_index, line in enumerate(fid, start=1):
+        line_dict = line_parser.parse(line, line_index)
+        if line_dict:
+            name = line_dict.pop('name')
+            result[name] = line_dict
+    return result
+
+
+def timeit(function, *args, repeat=3):
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function(*args)
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+
+if __name__ == '__main__':
+    copies = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+    base = Path(__file__).parent / 'data' / 'stir'
+    headers = sorted(base.glob('*.h[sv]'))
+    texts = [h.read_text() for h in headers]
+
+    def parse_all(parse):
+        for _ in range(copies):
+            for text in texts:
+                parse(text)
+
+    legacy = timeit(parse_all, legacy_parse_string)
+    current = timeit(parse_all, parse_header_string)
+    num = copies * len(texts)
+    print('{} headers'.format(num))
+    print('{:24} {:8.3f} s'.format('LineParser', legacy))
+    print('{:24} {:8.3f} s  ({:.1f}x)'.format('parse_header_string', current, legacy / current))
+
+    directory = tempfile.mkdtemp()
+    try:
+        paths = []
+        for i in range(copies):
+            for header in headers:
+                path = os.path.join(directory, '{}_{}'.format(i, header.name))
+                shutil.copyfile(str(header), path)
+                paths.append(path)
+        clear_header_cache()
+        for num_threads in [1, 4]:
+            uncached = timeit(parse_many, paths, num_threads, False)
+            print('{:24} {:8.3f} s'.format('parse_many, {} thread(s)'.format(num_threads), uncached))
+        parse_many(paths)
+        cached = timeit(parse_many, paths)
+        print('{:24} {:8.3f} s'.format('parse_many, cached', cached))
+    finally:
+        shutil.rmtree(directory)
@@ -0,0 +1,57 @@
+"""
+Benchmark of the PETLink 32-bit listmode decoders.
+
+Compares decoding one word at a time with the packet parts against the
+vectorized `decode`, in words per second, on synthetic listmode data (one
+time marker every 1000 words, as for a rate of 1M events per second) or on
+a listmode file.
+
+Run with ``python examples/benchmark_petlink32.py [number of words | listmode file]``.
+"""
+
+import sys
+import time
+
+import numpy as np
+
+from odlpet.utils import petlink32 as pl
+
+
+def synthetic_words(num, seed=0):
+    rng = np.random.RandomState(seed)
+    words = rng.randint(0, 2**31, size=num).astype(pl.WORD_DTYPE)
+    markers = np.arange(0, num, 1000)
+    words[markers] = (0b100 << 29) | np.arange(len(markers), dtype=np.uint32)
+    return words
+
+
+def decode_per_word(words):
+    bins, prompts, times = [], [], []
+    current = 0
+    for word in words.tolist():
+        if pl.EVENT.compare(word):
+            bins.append(pl.BIN_ADDRESS.evaluate(word))
+            prompts.append(pl.PROMPT.compare(word))
+            times.append(current)
+        elif pl.ELAPSED_TIME_MARKER.compare(word):
+            current = pl.TIME_MS.evaluate(word)
+    return bins, prompts, times
+
+
+def rate(function, words, repeat=3):
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function(words)
+        times.append(time.perf_counter() - start)
+    return len(words) / min(times)
+
+
+if __name__ == '__main__':
+    argument = sys.argv[1] if len(sys.argv) > 1 else str(10**8)
+    words = synthetic_words(int(argument)) if argument.isdigit() else pl.read_words(argument)
+    print('{} words'.format(len(words)))
+    per_word = rate(decode_per_word, words[:10**6], repeat=1)
+    print('{:24} {:12.3e} words/s'.format('per word', per_word))
+    vectorized = rate(lambda w: list(pl.iter_decode(w)), words)
+    print('{:24} {:12.3e} words/s  ({:.0f}x)'.format('iter_decode', vectorized, vectorized / per_word))
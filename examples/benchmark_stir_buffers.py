@@ -0,0 +1,94 @@
+"""
+Benchmark of the data transfers between ODL elements and STIR buffers.
+
+Compares the previous transfer path of `call_with_stir_buffer`
+(``fill(v.asarray().flat)``, ``to_numpy`` and ``out[:] = res``, with the
+volume filled twice in the forward projection) against the current one,
+which fills STIR once and reads the result straight into ``out``.
+
+The memory is measured with `tracemalloc`, as the peak of the Python and
+NumPy allocations during one projection. Copies made inside STIR, and the
+element by element iteration of ``fill(array.flat)`` that both paths still
+use to fill STIR, are not counted.
+
+Run with ``python examples/benchmark_stir_buffers.py``.
+"""
+
+import time
+import tracemalloc
+
+from stirextra import to_numpy
+
+from odlpet.scanner.scanner import mCT
+from odlpet.scanner.compression import Compression
+from odlpet.stir.bindings import call_with_stir_buffer
+
+
+def legacy_forward(proj, volume, out):
+    proj.volume.fill(volume.asarray().flat)
+    proj.volume.fill(volume.asarray().flat)
+    proj.projector.forward_project(proj.proj_data, proj.volume, 0, 1)
+    out[:] = to_numpy(proj.proj_data)
+
+
+def legacy_back(back, projections, out):
+    back.proj_data.fill(projections.asarray().flat)
+    back.volume.fill(0)
+    back.back_projector.back_project(back.volume, back.proj_data, 0, 1)
+    out[:] = to_numpy(back.volume)
+
+
+def current_forward(proj, volume, out):
+    call_with_stir_buffer(proj.projector.forward_project,
+                          proj.volume, proj.proj_data, volume, out=out)
+
+
+def current_back(back, projections, out):
+    call_with_stir_buffer(back.back_projector.back_project,
+                          back.proj_data, back.volume, projections,
+                          clear_buffer=True, out=out)
+
+
+def allocated_bytes(function, *args):
+    """
+    Peak of the Python and NumPy memory allocated by one call, measured
+    with `tracemalloc`.
+    """
+    tracemalloc.start()
+    try:
+        function(*args)
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def timeit(function, *args, repeat=3):
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function(*args)
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+
+if __name__ == '__main__':
+    compression = Compression(mCT())
+    proj = compression.get_projector()
+    back = proj.adjoint
+
+    volume = proj.domain.one()
+    projections = proj.range.one()
+    volume_bytes = volume.size * volume.space.dtype.itemsize
+    data_bytes = projections.size * projections.space.dtype.itemsize
+
+    runs = {
+        'forward (before)': (legacy_forward, proj, volume, proj.range.element()),
+        'forward (after)': (current_forward, proj, volume, proj.range.element()),
+        'back (before)': (legacy_back, back, projections, back.range.element()),
+        'back (after)': (current_back, back, projections, back.range.element()),
+    }
+
+    print('volume: {} bytes, projections: {} bytes'.format(volume_bytes, data_bytes))
+    for name, run in runs.items():
+        print('{:18} {:>12} bytes allocated {:8.3f} s'.format(
+            name, allocated_bytes(*run), timeit(*run)))
@@ -12,6 +12,7 @@ from __future__ import division
 import os.path as pth
 import odl
 from odlpet.stir.io import projector_from_file
+from odlpet.stir.bindings import NormalProjectorByBinWrapper
 
 
 
@@ -32,7 +33,8 @@ def test_from_file():
     projections = proj(vol)
 
     # Calculate operator norm for landweber
-    op_norm_est_squared = proj.adjoint(projections).norm() / vol.norm()
+    normal = NormalProjectorByBinWrapper(proj)
+    op_norm_est_squared = normal(vol).norm() / vol.norm()
     omega = 0.5 / op_norm_est_squared
 
     # Reconstruct using ODL
@@ -1,8 +1,17 @@
+import copy
+from collections import namedtuple
+
 import numpy as np
-from ..stir.space import space_from_stir_domain
-from ..stir.bindings import ForwardProjectorByBinWrapper, get_view_mask
-from .sinogram import get_offset, get_range_from_proj_data
-from .scanner import Scanner
+from ..stir.space import space_from_stir_domain, stir_domain_parameters
+from ..stir.bindings import ForwardProjectorByBinWrapper
+from ..stir.system_matrix import get_system_matrix, SystemMatrixOperator
+from ..stir.parallel import ParallelForwardProjector
+from .sinogram import (get_offset, get_sinogram_info, get_range_from_proj_data,
+                       get_subset_views,
+                       make_sinogram_table, get_rows, get_segment_axial,
+                       get_ring_pair_rows, get_row_ring_pairs,
+                       get_segment_view, iter_segments)
+from .scanner import Scanner, ACCESSOR_MAPPING
 from ..utils.slicing import SlicingProjectionOperator
 
 from stir import (FloatCartesianCoordinate3D,
@@ -12,6 +21,16 @@ from stir import (FloatCartesianCoordinate3D,
                   ExamInfo,
                   ProjDataInfo)
 
+# Snapshot of the STIR geometry of a compression, see `Compression.get_geometry`.
+# key: the compression and scanner parameters it was built from
+# sinogram_info: list of (segment, number of axial positions)
+# segment_offsets: dict of the first sinogram of each segment
+# table: `SinogramTable` of the sinogram rows and their ring pairs
+CompressionGeometry = namedtuple('CompressionGeometry',
+                                 ['key', 'proj_data_info', 'sinogram_info',
+                                  'segment_offsets', 'table'])
+
+
 class Compression:
     def __init__(self, scanner=None):
         """
@@ -119,39 +138,222 @@ class Compression:
         return FloatVoxelsOnCartesianGrid(proj_info, np.float32(zoom), offset_, sizes_)
 
     def _get_sinogram_info(self):
-        proj_info = self.get_stir_proj_data_info()
-        segments = list(range(proj_info.get_min_segment_num(), proj_info.get_max_segment_num()+1))
-        segment_sizes = [proj_info.get_max_axial_pos_num(s)+1 - proj_info.get_min_axial_pos_num(s) for s in segments]
-        return list(zip(segments, segment_sizes))
+        return self.get_geometry().sinogram_info
 
     def get_offset(self, segment, axial):
-        info = self._get_sinogram_info()
-        return get_offset(segment, axial, info)
+        geometry = self.get_geometry()
+        try:
+            max_axial = dict(geometry.sinogram_info)[segment]
+        except KeyError:
+            raise ValueError("Segment {} not in {}".format(segment, list(geometry.segment_offsets.keys())))
+        if not 0 <= axial < max_axial:
+            raise ValueError("Segment {}: Axial offset violation: 0 <= {} < {}".format(segment, axial, max_axial))
+        return geometry.segment_offsets[segment] + axial
+
+    def get_segment_view(self, sinograms, segments):
+        """
+        View, without copy, of the sinograms of one segment or of several
+        segments contiguous in storage, see `get_segment_view`.
+        """
+        return get_segment_view(sinograms, segments, self._get_sinogram_info())
+
+    def iter_segments(self, sinograms):
+        """
+        Iterate over (segment, view of its sinograms) in storage order.
+        """
+        return iter_segments(sinograms, self._get_sinogram_info())
+
+    def get_rows(self, segments, axials):
+        """
+        Sinogram rows of arrays of segment and axial positions.
+        """
+        return get_rows(segments, axials, self.get_geometry().table)
+
+    def get_segment_axial(self, rows):
+        """
+        Segments and axial positions of an array of sinogram rows.
+        """
+        return get_segment_axial(rows, self.get_geometry().table)
+
+    def get_ring_pair_rows(self, ring1, ring2):
+        """
+        Sinogram rows of arrays of ring pairs, -1 for pairs not in the data.
+        """
+        return get_ring_pair_rows(ring1, ring2, self.get_geometry().table)
+
+    def get_row_ring_pairs(self, rows):
+        """
+        Ring pairs of an array of sinogram rows, see `get_row_ring_pairs`.
+        """
+        return get_row_ring_pairs(rows, self.get_geometry().table)
+
+    def _geometry_key(self):
+        scanner = self.scanner
+        return ((type(scanner).__name__,)
+                + tuple(getattr(scanner, pa) for (sa, pa, ty) in ACCESSOR_MAPPING)
+                + (self.span_num, self.max_diff_ring, self.num_of_views,
+                   self.get_num_tangential(), self.data_arc_corrected))
+
+    def get_geometry(self):
+        """
+        The STIR projection data info and sinogram layout of this compression.
+
+        The snapshot is built once, and again only when the compression
+        parameters or the scanner have changed since.
+        """
+        geometry = self.__dict__.get('_geometry')
+        if geometry is None or geometry.key != self._geometry_key():
+            proj_data_info = self._make_stir_proj_data_info()
+            info = get_sinogram_info(proj_data_info)
+            offsets = {segment: int(get_offset(segment, 0, info)) for (segment, _) in info}
+            try:
+                table = make_sinogram_table(info, self.scanner.num_rings,
+                                            self.span_num, self.max_diff_ring)
+            except ValueError:
+                # a layout we cannot map to ring pairs
+                table = make_sinogram_table(info)
+            # the key is taken afterwards, as building the STIR scanner
+            # fills in the default number of bins
+            geometry = CompressionGeometry(self._geometry_key(), proj_data_info,
+                                           info, offsets, table)
+            self._geometry = geometry
+        return geometry
+
+    def __getstate__(self):
+        # the geometry holds STIR objects, it is rebuilt when needed
+        state = self.__dict__.copy()
+        state.pop('_geometry', None)
+        return state
 
 
     def get_projector(self, stir_domain=None, stir_proj_data_info=None,
                       subset_num=0, num_subsets=1,
-                      restrict_to_cylindrical_FOV=True):
+                      restrict_to_cylindrical_FOV=True,
+                      matrix_cache=None, num_workers=1):
+        """
+        Forward projector for this compression.
+
+        matrix_cache: a `SystemMatrixCache` or a cache directory.
+        When given, the ray tracing system matrix is loaded from the cache
+        (computed and stored if missing), and the projector is a
+        `SystemMatrixOperator` with the same domain and range, applying
+        the matrix with SciPy. The cached matrix does not speed up the
+        STIR projectors, which do not use it.
+
+        num_workers: when larger than one, the projector is a
+        `ParallelForwardProjector` splitting each projection by subsets of
+        views over that many worker processes.
+        """
         if stir_domain is None:
             stir_domain = self.get_stir_domain()
 
         stir_proj_data = self.get_stir_proj_data(stir_proj_data_info)
 
         recon_sp = space_from_stir_domain(stir_domain)
-        data_sp = get_range_from_proj_data(stir_proj_data, radius=self.scanner.det_radius)
+        data_sp = get_range_from_proj_data(stir_proj_data, radius=self.scanner.det_radius,
+                                           subset_num=subset_num, num_subsets=num_subsets)
 
-        return ForwardProjectorByBinWrapper(
+        # the geometry is entirely described by this object, unless
+        # stir_proj_data_info is given
+        if stir_proj_data_info is None:
+            description = {
+                'compression': copy.deepcopy(self),
+                'domain': stir_domain_parameters(stir_domain),
+                'subset_num': subset_num,
+                'num_subsets': num_subsets,
+                'restrict_to_cylindrical_FOV': restrict_to_cylindrical_FOV,
+            }
+        else:
+            description = None
+
+        if matrix_cache is not None:
+            proj = self.get_matrix_projector(
+                stir_domain=stir_domain, stir_proj_data_info=stir_proj_data_info,
+                subset_num=subset_num, num_subsets=num_subsets,
+                restrict_to_cylindrical_FOV=restrict_to_cylindrical_FOV,
+                matrix_cache=matrix_cache)
+            if description is not None:
+                proj.description = dict(description, matrix_cache=matrix_cache)
+            return proj
+
+        proj = ForwardProjectorByBinWrapper(
             recon_sp, data_sp,
             stir_domain, stir_proj_data,
             subset_num=subset_num, num_subsets=num_subsets,
             restrict_to_cylindrical_FOV=restrict_to_cylindrical_FOV)
+        proj.description = description
+        if num_workers > 1:
+            return ParallelForwardProjector(proj, num_workers)
+        return proj
+
+    def get_system_matrix(self, stir_domain=None, stir_proj_data_info=None,
+                          segments=None, subset_num=0, num_subsets=1,
+                          restrict_to_cylindrical_FOV=True, matrix_cache=None):
+        """
+        Ray tracing system matrix as a `scipy.sparse.csr_matrix`.
+
+        Rows are the bins of the projection data, in the layout of the range
+        of `get_projector`, columns the voxels of the domain.
+
+        segments: only keep the rows of these segments.
+        subset_num, num_subsets: only keep the rows of the views of a subset.
+        matrix_cache: a `SystemMatrixCache` or a cache directory for the
+        full matrix, see `get_system_matrix`.
+        """
+        if stir_domain is None:
+            stir_domain = self.get_stir_domain()
+        if stir_proj_data_info is None:
+            stir_proj_data_info = self.get_stir_proj_data_info()
+        return get_system_matrix(
+            self, stir_domain, stir_proj_data_info, cache=matrix_cache,
+            restrict_to_cylindrical_FOV=restrict_to_cylindrical_FOV,
+            segments=segments, subset_num=subset_num, num_subsets=num_subsets)
+
+    def get_matrix_projector(self, stir_domain=None, stir_proj_data_info=None,
+                             subset_num=0, num_subsets=1,
+                             restrict_to_cylindrical_FOV=True, matrix_cache=None):
+        """
+        Forward projector applying the system matrix with SciPy.
+
+        The `SystemMatrixOperator` has the domain and range of the
+        projector returned by `get_projector` with the same arguments, and
+        projects stacks of volumes at once with its `apply_batch` method.
+        """
+        if stir_domain is None:
+            stir_domain = self.get_stir_domain()
+        stir_proj_data = self.get_stir_proj_data(stir_proj_data_info,
+                                                 initialize_to_zero=False)
+        recon_sp = space_from_stir_domain(stir_domain)
+        data_sp = get_range_from_proj_data(stir_proj_data, radius=self.scanner.det_radius,
+                                           subset_num=subset_num, num_subsets=num_subsets)
+        matrix = self.get_system_matrix(
+            stir_domain=stir_domain,
+            stir_proj_data_info=stir_proj_data.get_proj_data_info(),
+            subset_num=subset_num, num_subsets=num_subsets,
+            restrict_to_cylindrical_FOV=restrict_to_cylindrical_FOV,
+            matrix_cache=matrix_cache)
+        return SystemMatrixOperator(recon_sp, data_sp, matrix)
 
     def get_projectors(self, num_subsets=1,
                        stir_domain=None, stir_proj_data_info=None,
                        restrict_to_cylindrical_FOV=True):
-        projs = [self.get_projector(stir_domain, stir_proj_data_info, i, num_subsets, restrict_to_cylindrical_FOV) for i in range(num_subsets)]
-        masks = [get_view_mask(proj) for proj in projs]
-        slice_ops = [SlicingProjectionOperator(proj.range, slicing=(slice(None), mask, slice(None))) for (proj,mask) in zip(projs, masks)]
+        """
+        Projectors on each subset of views, with the corresponding slicing
+        operators of the projection data.
+
+        All the subset projectors share one STIR projection matrix, volume
+        and projection data; only the subset index differs.
+        The range of each subset projector only contains the views of that
+        subset; the slicing operators map full projection data to those
+        ranges.
+        """
+        full_proj = self.get_projector(stir_domain, stir_proj_data_info,
+                                       restrict_to_cylindrical_FOV=restrict_to_cylindrical_FOV)
+        projs = [full_proj.get_subset(i, num_subsets) for i in range(num_subsets)]
+        num_views = full_proj.range.shape[1]
+        slice_ops = [SlicingProjectionOperator(full_proj.range, proj.range,
+                                               slicing=(slice(None), get_subset_views(num_views, i, num_subsets), slice(None)))
+                     for (i, proj) in enumerate(projs)]
         return projs, slice_ops
 
     def get_default_num_tangential(self):
@@ -172,6 +374,16 @@ class Compression:
         return self.scanner.num_rings - 1
 
     def get_stir_proj_data_info(self):
+        """
+        The STIR projection data info of this compression.
+
+        It is the object cached by `get_geometry`, shared by every caller
+        and by the projectors built since, so it must not be modified: use
+        ``.clone()`` to get a copy that can be.
+        """
+        return self.get_geometry().proj_data_info
+
+    def _make_stir_proj_data_info(self):
         _stir_scanner = self.scanner.get_stir_scanner()
         proj_data_info = ProjDataInfo.ProjDataInfoCTI(
             _stir_scanner,
@@ -182,5 +394,3 @@ class Compression:
             self.data_arc_corrected)
         return proj_data_info
 
-
-
@@ -0,0 +1,285 @@
+"""
+Rebinning of projection data between two compressions of a scanner.
+
+The rebinnings are linear maps acting along one axis of the
+(sinograms, views, tangential) projection data. They are precomputed as
+sparse matrices and applied as a single sparse product on the whole array.
+"""
+
+import copy
+
+import numpy as np
+import scipy.sparse
+
+from odl.discr import uniform_discr
+from odl.operator import Operator
+
+from .scanner import ACCESSOR_MAPPING
+from .sinogram import get_range_from_proj_data
+
+
+class SinogramRebinningOperator(Operator):
+
+    """A linear map applied along one axis of projection data."""
+
+    def __init__(self, domain, range, matrix, axis=0, adjoint=None):
+        """Initialize a new instance.
+
+        Parameters
+        ----------
+        domain, range : `DiscreteLp`
+            Spaces of (sinograms, views, tangential) projection data, equal
+            except along ``axis``.
+        matrix : `scipy.sparse.spmatrix`
+            Matrix of shape ``(range.shape[axis], domain.shape[axis])``.
+        axis : int, optional
+            Axis the matrix acts on.
+        adjoint : `SinogramRebinningOperator`, optional
+            A pre-initialized adjoint.
+        """
+        if matrix.shape != (range.shape[axis], domain.shape[axis]):
+            raise ValueError('matrix shape {} does not match ({}, {})'
+                             ''.format(matrix.shape, range.shape[axis], domain.shape[axis]))
+        super().__init__(domain, range, linear=True)
+        self.matrix = scipy.sparse.csr_matrix(matrix)
+        self.axis = axis
+        self._adjoint = adjoint
+
+    def _call(self, x, out):
+        """Apply the matrix along the axis."""
+        array = np.moveaxis(np.asarray(x), self.axis, 0)
+        result = self.matrix.dot(array.reshape(array.shape[0], -1))
+        out_shape = np.moveaxis(np.empty(self.range.shape, dtype=bool), self.axis, 0).shape
+        out[:] = np.moveaxis(result.reshape(out_shape), 0, self.axis)
+
+    @property
+    def adjoint(self):
+        """
+        Operator applying the transposed matrix, scaled by the ratio of the
+        cell volumes of the range and domain, which weight their inner
+        products (they differ when views or tangential positions are mashed).
+
+        The adjoints of the STIR projectors are plain transposes, which
+        ignore the cell volumes. Where the ratio is not 1, composing this
+        adjoint with theirs mixes the two conventions; use ``matrix.T`` for
+        a plain transpose matching the projectors.
+        """
+        if self._adjoint is None:
+            weight = self.range.cell_volume / self.domain.cell_volume
+            self._adjoint = SinogramRebinningOperator(
+                self.range, self.domain, self.matrix.T * weight, axis=self.axis, adjoint=self)
+        return self._adjoint
+
+
+def get_projection_space(compression):
+    """The range of the projectors of a compression, see `get_range_from_proj_data`."""
+    return get_range_from_proj_data(compression.get_stir_proj_data_info(),
+                                    radius=compression.scanner.det_radius)
+
+
+def get_span_matrix(source, target):
+    """
+    Sparse matrix summing the sinograms of a compression into those of
+    another compression of the same scanner, with a larger span or a
+    smaller maximum ring difference.
+
+    Every ring pair of a source sinogram must belong to a single target
+    sinogram. Sinograms whose ring pairs are not in the target are dropped.
+    """
+    r1, r2, which = source.get_row_ring_pairs(np.arange(source.get_stir_proj_data_info().get_num_sinograms()))
+    rows = target.get_ring_pair_rows(r1, r2)
+    # each source sinogram must go to exactly one target sinogram, or none
+    pairs = np.unique(np.stack([which, rows], axis=1), axis=0)
+    if len(pairs) != len(np.unique(which)):
+        raise ValueError('The sinograms of span {} cannot be rebinned to span {} with '
+                         'maximum ring difference {}'.format(source.span_num, target.span_num,
+                                                             target.max_diff_ring))
+    pairs = pairs[pairs[:, 1] >= 0]
+    shape = (target.get_stir_proj_data_info().get_num_sinograms(),
+             source.get_stir_proj_data_info().get_num_sinograms())
+    return scipy.sparse.csr_matrix(
+        (np.ones(len(pairs), dtype=np.float32), (pairs[:, 1], pairs[:, 0])), shape=shape)
+
+
+def get_span_rebinning(source, target):
+    """
+    Operator rebinning projection data of the ``source`` compression to the
+    larger span or smaller maximum ring difference of ``target``.
+
+    Both compressions must have the same scanner, views and tangential
+    positions. The adjoint copies each target sinogram back to the source
+    sinograms summed into it.
+    """
+    domain, range = get_projection_space(source), get_projection_space(target)
+    _check_same(source, target, ['num_of_views', 'get_num_tangential', 'data_arc_corrected'])
+    return SinogramRebinningOperator(domain, range, get_span_matrix(source, target), axis=0)
+
+
+def get_ssrb_compression(compression):
+    """
+    Compression with only direct sinograms (segment 0) of the same scanner,
+    views and tangential positions, to rebin ``compression`` into with
+    `get_ssrb`.
+
+    With span 3 and maximum ring difference 1, segment 0 has ``2*num_rings - 1``
+    sinograms sampled at half the ring spacing, one for every axial
+    position ``ring1 + ring2`` of the oblique ring pairs.
+    """
+    target = copy.deepcopy(compression)
+    target.span_num = 3
+    target.max_diff_ring = 1
+    return target
+
+
+def get_ssrb_matrix(source, target):
+    """
+    Sparse single slice rebinning matrix, see `get_ssrb`.
+    """
+    num_rings = source.scanner.num_rings
+    r1, r2, which = source.get_row_ring_pairs(np.arange(source.get_stir_proj_data_info().get_num_sinograms()))
+    t1, t2, target_rows = target.get_row_ring_pairs(np.arange(target.get_stir_proj_data_info().get_num_sinograms()))
+    if np.any(target.get_segment_axial(target_rows)[0] != 0):
+        raise ValueError('The target of SSRB must only have segment 0')
+    # target sinogram of each axial position ring1 + ring2
+    plane_rows = np.full(2*num_rings - 1, -1)
+    plane_rows[t1 + t2] = target_rows
+    rows = plane_rows[r1 + r2]
+    # weights such that each target sinogram gets the mean of the source
+    # ring pairs at its axial position, times its own number of ring pairs
+    source_pairs = np.bincount(r1 + r2, minlength=2*num_rings - 1)
+    target_pairs = np.bincount(t1 + t2, minlength=2*num_rings - 1)
+    # a source sinogram with several ring pairs (span > 1) has one entry per
+    # pair, all at the same axial position; they are summed, so each entry
+    # gets its share of the sinogram weight
+    multiplicity = np.bincount(which)[which]
+    weights = target_pairs[r1 + r2] / source_pairs[r1 + r2] / multiplicity
+    shape = (target.get_stir_proj_data_info().get_num_sinograms(),
+             source.get_stir_proj_data_info().get_num_sinograms())
+    return scipy.sparse.csr_matrix(
+        (weights[rows >= 0].astype(np.float32), (rows[rows >= 0], which[rows >= 0])),
+        shape=shape)
+
+
+def get_ssrb(source, target=None):
+    """
+    Single slice rebinning (SSRB) of 3D projection data to direct sinograms.
+
+    Every ring pair is assigned to the direct sinogram at its mean axial
+    position ``(ring1 + ring2)/2``. Each target sinogram gets the mean of
+    the source ring pairs at its axial position, scaled by its own number
+    of ring pairs, so the rebinned data matches what ``target`` would
+    measure and can be reconstructed with ``target.get_projector()``, a
+    projector on far fewer sinograms than the 3D one.
+
+    Parameters
+    ----------
+    source : `Compression`
+    target : `Compression`, optional
+        Compression with only segment 0 and the same scanner, views and
+        tangential positions. Defaults to `get_ssrb_compression`.
+    """
+    if target is None:
+        target = get_ssrb_compression(source)
+    domain, range = get_projection_space(source), get_projection_space(target)
+    _check_same(source, target, ['num_of_views', 'get_num_tangential', 'data_arc_corrected'])
+    return SinogramRebinningOperator(domain, range, get_ssrb_matrix(source, target), axis=0)
+
+
+def get_view_mashing(source, target):
+    """
+    Operator mashing the views of the ``source`` compression into the
+    fewer views of ``target``.
+
+    The number of views of ``target`` must divide that of ``source`` by an
+    odd factor ``f``; view ``v`` of the target sums the views
+    ``v*f, ..., v*f + f - 1`` of the source. Their mean angle is
+    ``(f - 1)/2`` source views, i.e. ``(f - 1)/2 * pi/num_views``, past the
+    angle of view ``v`` of the ``target`` projectors: the groups are not
+    centred on the target angles, which would need the first group to wrap
+    around to the last views with mirrored tangential positions and
+    segments. An odd factor keeps that offset a whole number of source
+    views. The adjoint copies each target view back to the source views
+    summed into it, multiplied by ``f``, the ratio of the view cells (see
+    `SinogramRebinningOperator.adjoint`).
+    """
+    num_views, num_mashed = source.num_of_views, target.num_of_views
+    if num_views % num_mashed or not (num_views // num_mashed) % 2:
+        raise ValueError('{} views cannot be mashed into {} by an odd factor'
+                         ''.format(num_views, num_mashed))
+    domain, range = get_projection_space(source), get_projection_space(target)
+    _check_same(source, target, ['span_num', 'max_diff_ring', 'get_num_tangential',
+                                 'data_arc_corrected'])
+    factor = num_views // num_mashed
+    matrix = scipy.sparse.csr_matrix(
+        (np.ones(num_views, dtype=np.float32),
+         (np.arange(num_views) // factor, np.arange(num_views))),
+        shape=(num_mashed, num_views))
+    return SinogramRebinningOperator(domain, range, matrix, axis=1)
+
+
+def get_tangential_rebinning(source, target):
+    """
+    Operator from the tangential positions of the ``source`` compression to
+    those of ``target``.
+
+    Without arc correction the tangential sampling of STIR is given by the
+    scanner, so the number of tangential positions only sets the width of
+    the field of view: positions are kept, cropped or zero-padded around
+    the centre. The adjoint goes the other way, scaled by the ratio of the
+    tangential cells of the two spaces (see `SinogramRebinningOperator.adjoint`).
+    """
+    domain, range = get_projection_space(source), get_projection_space(target)
+    _check_same(source, target, ['span_num', 'max_diff_ring', 'num_of_views',
+                                 'data_arc_corrected'])
+    num_source, num_target = domain.shape[2], range.shape[2]
+    # as in STIR, the tangential positions are -(n//2), ..., n - 1 - n//2
+    positions = np.arange(num_source) - num_source//2
+    target_index = positions + num_target//2
+    kept = (target_index >= 0) & (target_index < num_target)
+    matrix = scipy.sparse.csr_matrix(
+        (np.ones(kept.sum(), dtype=np.float32),
+         (target_index[kept], np.arange(num_source)[kept])),
+        shape=(num_target, num_source))
+    # the spaces span the same tangential extent, so their cells differ
+    return SinogramRebinningOperator(domain, range, matrix, axis=2)
+
+
+def get_tangential_mashing(space, factor):
+    """
+    Operator summing groups of ``factor`` adjacent tangential positions of
+    projection data in ``space``, for coarse previews.
+
+    The range covers the same tangential extent with ``factor`` times fewer
+    positions; it does not correspond to a STIR geometry.
+    """
+    num_tangential = space.shape[2]
+    if num_tangential % factor:
+        raise ValueError('{} tangential positions cannot be mashed by {}'
+                         ''.format(num_tangential, factor))
+    range = uniform_discr(min_pt=space.min_pt, max_pt=space.max_pt,
+                          shape=space.shape[:2] + (num_tangential // factor,),
+                          axis_labels=space.axis_labels, dtype=space.dtype)
+    matrix = scipy.sparse.csr_matrix(
+        (np.ones(num_tangential, dtype=np.float32),
+         (np.arange(num_tangential) // factor, np.arange(num_tangential))),
+        shape=(num_tangential // factor, num_tangential))
+    return SinogramRebinningOperator(space, range, matrix, axis=2)
+
+
+def _check_same(source, target, attributes):
+    """
+    Check that two compressions only differ in the rebinned dimension.
+    Their geometry must have been built, which fills in the scanner defaults.
+    """
+    if _scanner_parameters(source.scanner) != _scanner_parameters(target.scanner):
+        raise ValueError('The compressions must have the same scanner')
+    for name in attributes:
+        value, other = getattr(source, name), getattr(target, name)
+        if callable(value):
+            value, other = value(), other()
+        if value != other:
+            raise ValueError('The compressions differ in {}: {} != {}'.format(name, value, other))
+
+
+def _scanner_parameters(scanner):
+    return [getattr(scanner, pa) for (sa, pa, ty) in ACCESSOR_MAPPING]
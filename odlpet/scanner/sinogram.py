@@ -2,6 +2,8 @@
 Utility functions related to sinograms.
 """
 
+from collections import namedtuple
+
 import numpy as np
 from odl.discr import uniform_discr
 
@@ -35,30 +37,253 @@ def get_offset(segment, axial, info):
     seg_offset = get_segment_offset(segment_reordered_(segment), info)
     return seg_offset + axial
 
-def get_shape_from_proj_data(proj_data):
+def get_sinogram_info(proj_data_info):
+    """
+    List of (segment, number of axial positions) for a STIR proj_data_info.
+    """
+    segments = list(range(proj_data_info.get_min_segment_num(), proj_data_info.get_max_segment_num()+1))
+    segment_sizes = [proj_data_info.get_max_axial_pos_num(s)+1 - proj_data_info.get_min_axial_pos_num(s) for s in segments]
+    return list(zip(segments, segment_sizes))
+
+def get_subset_views(num_views, subset_num=0, num_subsets=1):
+    """
+    Slice selecting the views of a subset.
+
+    As in STIR, subset `subset_num` consists of the views
+    `subset_num`, `subset_num + num_subsets`, ...
+    """
+    if not 0 <= subset_num < num_subsets:
+        raise ValueError("Subset {} not in range(0, {})".format(subset_num, num_subsets))
+    if num_subsets > num_views:
+        raise ValueError("More subsets ({}) than views ({})".format(num_subsets, num_views))
+    return slice(subset_num, num_views, num_subsets)
+
+def get_subset_view_mask(num_views, subset_num=0, num_subsets=1):
     """
-    Get shape from proj_data without converting to an array.
+    Boolean mask of the views of a subset, see `get_subset_views`.
+    """
+    mask = np.zeros(num_views, dtype=bool)
+    mask[get_subset_views(num_views, subset_num, num_subsets)] = True
+    return mask
+
+def get_segment_sinograms(info, segments):
+    """
+    Indices of the sinograms of the given segments, in the sinogram order
+    of the projection data (segments 0, +1, -1, ...).
+    `info`: list of (segment, number of axial positions), see `get_sinogram_info`.
+    """
+    dinfo = dict(info)
+    missing = set(segments) - set(dinfo)
+    if missing:
+        raise ValueError("Segments {} not in {}".format(sorted(missing), list(dinfo.keys())))
+    return np.concatenate([np.arange(dinfo[segment]) + get_offset(segment, 0, info)
+                           for segment in sorted(set(segments), key=segment_reordered_)]
+                          + [np.zeros(0, dtype=int)])
+
+def get_segments_slice(segments, info):
+    """
+    Slice of the sinograms of one segment or of several segments.
+
+    Several segments must be stored next to each other, in the order
+    0, +1, -1, +2, ... of the projection data, for instance [0, 1, -1] or
+    [-1, 2].
+    `info`: list of (segment, number of axial positions), see `get_sinogram_info`.
+    """
+    segments = sorted(set(np.atleast_1d(segments).tolist()), key=segment_reordered_)
+    dinfo = dict(info)
+    missing = set(segments) - set(dinfo)
+    if missing:
+        raise ValueError("Segments {} not in {}".format(sorted(missing), list(dinfo.keys())))
+    stored = sorted(dinfo, key=segment_reordered_)
+    first = stored.index(segments[0])
+    if stored[first:first+len(segments)] != segments:
+        raise ValueError("Segments {} are not contiguous in the order {}".format(segments, stored))
+    start = get_offset(segments[0], 0, info)
+    stop = get_offset(segments[-1], 0, info) + dinfo[segments[-1]]
+    return slice(int(start), int(stop))
+
+def get_segment_view(sinograms, segments, info):
+    """
+    View, without copy, of the sinograms of one or several segments.
+
+    `sinograms`: array or ODL element of shape (sinograms, views, tangential),
+    for instance in the range of a projector. For an ODL element of a NumPy
+    space, the view shares the memory of the element.
+    `segments`: a segment, or several segments contiguous in storage
+    (see `get_segments_slice`).
+    """
+    array = sinograms if isinstance(sinograms, np.ndarray) else sinograms.asarray()
+    return array[get_segments_slice(segments, info)]
+
+def iter_segments(sinograms, info):
+    """
+    Iterate over the segments of the projection data in storage order,
+    yielding (segment, view) pairs (see `get_segment_view`).
+    """
+    array = sinograms if isinstance(sinograms, np.ndarray) else sinograms.asarray()
+    for segment in sorted(dict(info), key=segment_reordered_):
+        yield segment, array[get_segments_slice(segment, info)]
+
+def get_shape_from_proj_data(proj_data, subset_num=0, num_subsets=1):
+    """
+    Get shape from proj_data (or its ProjDataInfo) without converting to an array.
+
+    With subsets, only the views of the given subset are counted.
     """
     num_sinograms = proj_data.get_num_sinograms()
     num_views = proj_data.get_num_views()
     num_tans = proj_data.get_num_tangential_poss()
-    shape = (num_sinograms, num_views, num_tans)
+    views = get_subset_views(num_views, subset_num, num_subsets)
+    shape = (num_sinograms, len(range(num_views)[views]), num_tans)
     return shape
 
-def get_range_from_proj_data(proj_data, radius=1.):
+def get_range_from_proj_data(proj_data, radius=1., subset_num=0, num_subsets=1):
     """
-    Get an ODL codomain (range) from the projection data.
+    Get an ODL codomain (range) from the projection data, or from its
+    ``ProjDataInfo``, which has the same counts.
 
     The second coordinate is an angle.
     The last one is a tangential coordinate, normalised between -1 and 1.
     `radius`: units for the tangential coordinates
+    `subset_num`, `num_subsets`: restrict the range to the views of a subset
+    (see `get_subset_views`)
     """
-    shape = get_shape_from_proj_data(proj_data)
-    min_pt = [0, 0, -radius]
-    max_pt = [shape[0], np.pi, radius]
+    shape = get_shape_from_proj_data(proj_data, subset_num, num_subsets)
+    view_angle = np.pi / proj_data.get_num_views()
+    min_view = subset_num * view_angle
+    min_pt = [0, min_view, -radius]
+    max_pt = [shape[0], min_view + shape[1]*num_subsets*view_angle, radius]
     data_sp = uniform_discr(min_pt=min_pt,
                             max_pt=max_pt,
                             shape=shape,
                             axis_labels=("(dz,z)", "φ", "s"),
                             dtype='float32')
     return data_sp
+
+
+# Lookup tables of the sinogram rows of a geometry, see `make_sinogram_table`.
+# min_segment: smallest segment number
+# segment_offsets, segment_sizes: first row and number of axial positions
+#     of each segment, indexed by segment - min_segment
+# row_segments, row_axials: segment and axial position of each row
+# ring_pair_rows: (num_rings, num_rings) array of the row of each ring
+#     pair, -1 for pairs outside the data
+# pair_indptr, pair_rings: the ring pairs of row i are
+#     pair_rings[pair_indptr[i]:pair_indptr[i+1]], as (ring1, ring2)
+SinogramTable = namedtuple('SinogramTable',
+                           ['min_segment', 'segment_offsets', 'segment_sizes',
+                            'row_segments', 'row_axials', 'ring_pair_rows',
+                            'pair_indptr', 'pair_rings'])
+
+def get_ring_difference_segment(ring_difference, span):
+    """
+    Segment of a ring difference ``ring2 - ring1`` in a CTI geometry of the
+    given (odd) span. Works on arrays.
+    """
+    ring_difference = np.asarray(ring_difference)
+    return np.sign(ring_difference) * ((np.abs(ring_difference) + (span - 1)//2) // span)
+
+def get_ring_pair_axial(ring1, ring2, span):
+    """
+    Axial position of a ring pair in its segment, in a CTI geometry of the
+    given span. Works on arrays.
+
+    With span 1 the axial positions are the rings, otherwise they are
+    sampled at half the ring spacing.
+    """
+    ring1, ring2 = np.asarray(ring1), np.asarray(ring2)
+    segment = get_ring_difference_segment(ring2 - ring1, span)
+    if span == 1:
+        return np.minimum(ring1, ring2)
+    min_difference = np.maximum(np.abs(segment)*span - (span - 1)//2, 0)
+    return ring1 + ring2 - min_difference
+
+def make_sinogram_table(info, num_rings=None, span=None, max_diff_ring=None):
+    """
+    Lookup tables of the sinogram rows of a geometry.
+
+    `info`: list of (segment, number of axial positions), see `get_sinogram_info`.
+    `num_rings`, `span`, `max_diff_ring`: CTI geometry of the data. When
+    given, the ring pairs of each row are tabulated as well, and must agree
+    with `info`.
+    """
+    segments = np.array([segment for (segment, _) in info], dtype=int)
+    sizes = np.array([size for (_, size) in info], dtype=int)
+    min_segment = segments.min()
+    offsets = np.empty(len(info), dtype=int)
+    for (segment, _) in info:
+        offsets[segment - min_segment] = get_offset(segment, 0, info)
+    num_rows = sizes.sum()
+    row_segments = np.empty(num_rows, dtype=int)
+    row_axials = np.empty(num_rows, dtype=int)
+    for segment, offset, size in zip(segments, offsets, sizes):
+        row_segments[offset:offset+size] = segment
+        row_axials[offset:offset+size] = np.arange(size)
+
+    if num_rings is None:
+        ring_pair_rows = pair_indptr = pair_rings = None
+    else:
+        ring1, ring2 = np.meshgrid(np.arange(num_rings), np.arange(num_rings), indexing='ij')
+        pair_segments = get_ring_difference_segment(ring2 - ring1, span)
+        pair_axials = get_ring_pair_axial(ring1, ring2, span)
+        valid = ((np.abs(ring2 - ring1) <= max_diff_ring)
+                 & (pair_segments >= min_segment) & (pair_segments <= segments.max()))
+        if np.any(pair_axials[valid] >= sizes[pair_segments[valid] - min_segment]):
+            raise ValueError("Ring pairs of {} rings with span {} do not match the "
+                             "sinograms {}".format(num_rings, span, info))
+        ring_pair_rows = np.full((num_rings, num_rings), -1, dtype=int)
+        ring_pair_rows[valid] = offsets[pair_segments[valid] - min_segment] + pair_axials[valid]
+        # group the ring pairs by row
+        pairs = np.flatnonzero(valid.ravel())
+        pairs = pairs[np.argsort(ring_pair_rows.ravel()[pairs], kind='stable')]
+        pair_rings = np.stack([ring1.ravel()[pairs], ring2.ravel()[pairs]], axis=1)
+        counts = np.bincount(ring_pair_rows.ravel()[pairs], minlength=num_rows)
+        pair_indptr = np.concatenate([[0], np.cumsum(counts)])
+
+    return SinogramTable(min_segment, offsets, sizes, row_segments, row_axials,
+                         ring_pair_rows, pair_indptr, pair_rings)
+
+def get_rows(segments, axials, table):
+    """
+    Sinogram rows of arrays of segment and axial positions.
+    """
+    segments, axials = np.asarray(segments), np.asarray(axials)
+    index = segments - table.min_segment
+    if np.any((index < 0) | (index >= len(table.segment_sizes))):
+        raise ValueError("Segments {} out of range".format(np.unique(segments[(index < 0) | (index >= len(table.segment_sizes))])))
+    if np.any((axials < 0) | (axials >= table.segment_sizes[index])):
+        raise ValueError("Axial positions out of range")
+    return table.segment_offsets[index] + axials
+
+def get_segment_axial(rows, table):
+    """
+    Segment and axial position of an array of sinogram rows.
+    """
+    rows = np.asarray(rows)
+    return table.row_segments[rows], table.row_axials[rows]
+
+def get_ring_pair_rows(ring1, ring2, table):
+    """
+    Sinogram rows of arrays of ring pairs, -1 for pairs outside the data.
+    """
+    _check_ring_pairs(table)
+    return table.ring_pair_rows[np.asarray(ring1), np.asarray(ring2)]
+
+def get_row_ring_pairs(rows, table):
+    """
+    Ring pairs of an array of sinogram rows.
+
+    Returns (ring1, ring2, which): the ring pairs of all the rows, where
+    ``which`` is the index in ``rows`` of the row of each pair.
+    """
+    _check_ring_pairs(table)
+    rows = np.asarray(rows).ravel()
+    starts = table.pair_indptr[rows]
+    counts = table.pair_indptr[rows + 1] - starts
+    which = np.repeat(np.arange(len(rows)), counts)
+    pairs = np.repeat(starts - np.cumsum(counts) + counts, counts) + np.arange(counts.sum())
+    return table.pair_rings[pairs, 0], table.pair_rings[pairs, 1], which
+
+def _check_ring_pairs(table):
+    if table.ring_pair_rows is None:
+        raise ValueError("The ring pairs of this sinogram table are unknown")
@@ -12,7 +12,8 @@ Back and forward projectors for PET.
 
 `ForwardProjectorByBinWrapper` and `BackProjectorByBinWrapper` are general
 objects of STIR projectors and back-projectors, these can be used to wrap a
-given projector.
+given projector. `NormalProjectorByBinWrapper` applies both in a row,
+keeping the projection data in STIR.
 
 
 References
@@ -24,14 +25,23 @@ the STIR classes used here.
 .. _STIR doc: http://stir.sourceforge.net/documentation/doxy/html/
 """
 
-from stirextra import to_numpy
 from stir import (
+    ProjData,
     ProjMatrixByBinUsingRayTracing,
     ForwardProjectorByBinUsingProjMatrixByBin,
     BackProjectorByBinUsingProjMatrixByBin,
 )
 
-from ..scanner.sinogram import get_shape_from_proj_data
+from ..scanner.sinogram import (
+    get_offset,
+    get_range_from_proj_data,
+    get_shape_from_proj_data,
+    get_sinogram_info,
+    get_subset_view_mask,
+    get_subset_views,
+)
+
+from .space import space_from_stir_domain, stir_domain_from_parameters
 
 from odl.operator import Operator
 
@@ -51,7 +61,7 @@ class ForwardProjectorByBinWrapper(Operator):
                  _proj_info=None,
                  subset_num=0, num_subsets=1,
                  restrict_to_cylindrical_FOV=True,
-                 projector=None, adjoint=None):
+                 projector=None, back_projector=None, adjoint=None):
         """Initialize a new instance.
 
         Parameters
@@ -61,13 +71,19 @@ class ForwardProjectorByBinWrapper(Operator):
             ``volume.shape()``.
         range : `DiscreteLp`
             Projection space. Needs to have the same shape as
-            ``proj_data.to_array().shape()``.
+            ``proj_data.to_array().shape()``, restricted to the views of
+            the subset (see `get_subset_views`).
         volume : ``stir.FloatVoxelsOnCartesianGrid``
             Stir volume to use in the forward projection
         proj_data : ``stir.ProjData``
             Stir description of the projection.
+        subset_num, num_subsets : int, optional
+            Subset of views to project to.
         projector : ``stir.ForwardProjectorByBin``, optional
             A pre-initialized projector.
+        back_projector : ``stir.BackProjectorByBin``, optional
+            A pre-initialized back-projector for the adjoint, used together
+            with ``projector``.
         adjoint : `BackProjectorByBinWrapper`, optional
             A pre-initialized adjoint.
         """
@@ -75,7 +91,7 @@ class ForwardProjectorByBinWrapper(Operator):
         if domain.shape != volume.shape():
             raise ValueError('domain.shape {} does not equal volume shape {}'
                              ''.format(domain.shape, volume.shape()))
-        proj_shape = get_shape_from_proj_data(proj_data)
+        proj_shape = get_shape_from_proj_data(proj_data, subset_num, num_subsets)
         if range.shape != proj_shape:
             raise ValueError('range.shape {} does not equal proj shape {}'
                              ''.format(range.shape, proj_shape))
@@ -86,6 +102,10 @@ class ForwardProjectorByBinWrapper(Operator):
         self.num_subsets = num_subsets
         self.subset_num = subset_num
 
+        # Plain description from which the projector can be rebuilt in
+        # another process, set by `Compression.get_projector`
+        self.description = None
+
         # Read template of the projection
         self.proj_data = proj_data
         if _proj_info is None:
@@ -96,17 +116,9 @@ class ForwardProjectorByBinWrapper(Operator):
 
         # Create forward projection by matrix
         if projector is None:
-            self.proj_matrix = ProjMatrixByBinUsingRayTracing()
-            self.proj_matrix.set_do_symmetry_90degrees_min_phi(True)
-            self.proj_matrix.set_do_symmetry_180degrees_min_phi(True)
-            self.proj_matrix.set_do_symmetry_swap_s(True)
-            self.proj_matrix.set_do_symmetry_swap_segment(True)
-            self.proj_matrix.set_num_tangential_LORs(np.int32(1))
-
-            self.proj_matrix.set_up(self.proj_data_info, self.volume)
-
-            self.proj_matrix.set_restrict_to_cylindrical_FOV(restrict_to_cylindrical_FOV)
-
+            self.proj_matrix = make_proj_matrix(
+                self.proj_data_info, self.volume,
+                restrict_to_cylindrical_FOV=restrict_to_cylindrical_FOV)
 
             self.projector = ForwardProjectorByBinUsingProjMatrixByBin(self.proj_matrix)
 
@@ -121,9 +133,9 @@ class ForwardProjectorByBinWrapper(Operator):
                                        self.volume)
         else:
             # If user wants to provide both a projector and a back-projector,
-            # he should wrap the back projector in an Operator
+            # he should wrap the back projector in an Operator, or pass the
+            # STIR back-projector along
             self.projector = projector
-            back_projector = None
 
         # Pre-create an adjoint to save time
         if adjoint is None:
@@ -134,24 +146,121 @@ class ForwardProjectorByBinWrapper(Operator):
         else:
             self._adjoint = adjoint
 
-    def _call(self, volume, out):
-        """Forward project a volume."""
-        # Set volume data
-        self.volume.fill(volume.asarray().flat)
+    def get_subset(self, subset_num, num_subsets):
+        """Return the projector restricted to a subset of the views.
 
-        # project
-        res = call_with_stir_buffer(
-            self.projector.forward_project, self.volume, self.proj_data, volume,
-            self.subset_num, self.num_subsets)
+        The returned operator shares the STIR projection matrix,
+        projectors, volume and projection data with this one, so creating
+        it costs no set-up at all. Its range only contains the views of the
+        subset.
+        """
+        radius = self.range.max_pt[-1]
+        subset_range = get_range_from_proj_data(
+            self.proj_data, radius=radius,
+            subset_num=subset_num, num_subsets=num_subsets)
+        subset_proj = ForwardProjectorByBinWrapper(
+            self.domain, subset_range, self.volume, self.proj_data,
+            _proj_info=self.proj_data_info,
+            subset_num=subset_num, num_subsets=num_subsets,
+            projector=self.projector,
+            back_projector=self.adjoint.back_projector)
+        if self.description is not None:
+            subset_proj.description = dict(self.description,
+                                           subset_num=subset_num,
+                                           num_subsets=num_subsets)
+        return subset_proj
 
-        # make ODL data
-        out[:] = res
+    def _call(self, volume, out):
+        """Forward project a volume."""
+        if self.num_subsets == 1:
+            call_with_stir_buffer(
+                self.projector.forward_project, self.volume, self.proj_data, volume,
+                out=out)
+        else:
+            # only the views of the subset are projected and read back
+            fill_stir_buffer(self.volume, volume)
+            self.projector.forward_project(self.proj_data, self.volume,
+                                           self.subset_num, self.num_subsets)
+            read_views(self.proj_data, self.subset_num, self.num_subsets, out)
 
     @property
     def adjoint(self):
         """Back-projector associated with this operator."""
         return self._adjoint
 
+    def __reduce__(self):
+        """Pickle the projector as its description.
+
+        The projector is rebuilt lazily when unpickled, see
+        `_from_description`.
+        """
+        if self.description is None:
+            raise TypeError('Only projectors created by Compression.get_projector '
+                            'without stir_proj_data_info can be pickled')
+        return (_unpickle_projector, (self.description, False))
+
+    @classmethod
+    def _from_description(cls, description):
+        """Projector whose STIR objects are built on first use.
+
+        Only the domain and range are computed here; the STIR projection
+        matrix, projectors and buffers are built from ``description`` when
+        one of them is first needed (see `_set_up_from_description`).
+        """
+        compression = description['compression']
+        stir_domain = stir_domain_from_parameters(description['domain'])
+        domain = space_from_stir_domain(stir_domain)
+        # the counts of the info are enough, no projection data is allocated
+        range = get_range_from_proj_data(
+            compression.get_stir_proj_data_info(),
+            radius=compression.scanner.det_radius,
+            subset_num=description['subset_num'],
+            num_subsets=description['num_subsets'])
+
+        proj = cls.__new__(cls)
+        Operator.__init__(proj, domain, range, linear=True)
+        back = BackProjectorByBinWrapper.__new__(BackProjectorByBinWrapper)
+        Operator.__init__(back, range, domain, linear=True)
+        for op in (proj, back):
+            op.subset_num = description['subset_num']
+            op.num_subsets = description['num_subsets']
+        proj.description = description
+        proj._lazy = True
+        proj._adjoint = back
+        back._adjoint = proj
+        return proj
+
+    def _set_up_from_description(self):
+        """Build the STIR objects of a lazily unpickled projector."""
+        built = projector_from_description(self.description)
+        self._lazy = False
+        for name in _STIR_ATTRIBUTES:
+            if hasattr(built, name):
+                setattr(self, name, getattr(built, name))
+        for name in _STIR_ADJOINT_ATTRIBUTES:
+            setattr(self._adjoint, name, getattr(built.adjoint, name))
+
+    def __getattr__(self, name):
+        """Build the STIR objects of a lazily unpickled projector."""
+        if name in _STIR_ATTRIBUTES and self.__dict__.get('_lazy', False):
+            self._set_up_from_description()
+            return getattr(self, name)
+        raise AttributeError("'{}' object has no attribute '{}'"
+                             "".format(type(self).__name__, name))
+
+
+# STIR objects held by the projectors, built on first use when unpickled
+_STIR_ATTRIBUTES = ('proj_data', 'proj_data_info', 'volume',
+                    'projector', 'proj_matrix')
+_STIR_ADJOINT_ATTRIBUTES = ('proj_data', 'proj_data_info', 'volume',
+                            'back_projector')
+
+
+def _unpickle_projector(description, adjoint):
+    """Unpickle a projector (or its adjoint) from its description."""
+    proj = ForwardProjectorByBinWrapper._from_description(description)
+    return proj.adjoint if adjoint else proj
+
 
 class BackProjectorByBinWrapper(Operator):
 
@@ -166,7 +275,8 @@ class BackProjectorByBinWrapper(Operator):
         ----------
         domain : `DiscreteLp`
             Projection space. Needs to have the same shape as
-            ``proj_data.to_array().shape()``.
+            ``proj_data.to_array().shape()``, restricted to the views of
+            the subset (see `get_subset_views`).
         range : `DiscreteLp`
             Volume of the projection. Needs to have the same shape as
             ``volume.shape()``.
@@ -174,6 +284,8 @@ class BackProjectorByBinWrapper(Operator):
             Stir volume to use in the forward projection
         proj_data : ``stir.ProjData``
             Stir description of the projection.
+        subset_num, num_subsets : int, optional
+            Subset of views to back-project from.
         back_projector : ``stir.BackProjectorByBin``, optional
             A pre-initialized back-projector.
         adjoint : `ForwardProjectorByBinWrapper`, optional
@@ -191,7 +303,7 @@ class BackProjectorByBinWrapper(Operator):
         if range.shape != volume.shape():
             raise ValueError('`range.shape` {} does not equal volume shape {}'
                              ''.format(range.shape, volume.shape()))
-        proj_shape = get_shape_from_proj_data(proj_data)
+        proj_shape = get_shape_from_proj_data(proj_data, subset_num, num_subsets)
         if domain.shape != proj_shape:
             raise ValueError('`domain.shape` {} does not equal proj shape {}'
                              ''.format(range.shape, proj_shape))
@@ -229,39 +341,281 @@ class BackProjectorByBinWrapper(Operator):
         if adjoint is None:
             self._adjoint = ForwardProjectorByBinWrapper(
                 self.range, self.domain, self.volume, self.proj_data,
-                projector, self)
+                subset_num=subset_num, num_subsets=num_subsets,
+                projector=projector, back_projector=self.back_projector,
+                adjoint=self)
         else:
             self._adjoint = adjoint
 
     def _call(self, projections, out):
         """Back project."""
-        res = call_with_stir_buffer(
-            self.back_projector.back_project, self.proj_data, self.volume, projections,
-            self.subset_num, self.num_subsets,
-            clear_buffer=True)
-
-        # make ODL data
-        out[:] = res
+        if self.num_subsets == 1:
+            call_with_stir_buffer(
+                self.back_projector.back_project, self.proj_data, self.volume, projections,
+                clear_buffer=True, out=out)
+        else:
+            # only the views of the subset are filled and back-projected
+            fill_views(self.proj_data, self.subset_num, self.num_subsets, projections)
+            self.volume.fill(0)
+            self.back_projector.back_project(self.volume, self.proj_data,
+                                             self.subset_num, self.num_subsets)
+            read_stir_buffer(self.volume, out)
 
     @property
     def adjoint(self):
         """Back-projector associated with this operator."""
         return self._adjoint
 
+    def __reduce__(self):
+        """Pickle the back-projector as the description of its adjoint."""
+        adjoint = self._adjoint
+        if getattr(adjoint, 'description', None) is None:
+            raise TypeError('Only back-projectors of projectors created by '
+                            'Compression.get_projector can be pickled')
+        return (_unpickle_projector, (adjoint.description, True))
+
+    def __getattr__(self, name):
+        """Build the STIR objects of a lazily unpickled back-projector."""
+        adjoint = self.__dict__.get('_adjoint')
+        if (name in _STIR_ADJOINT_ATTRIBUTES and adjoint is not None
+                and adjoint.__dict__.get('_lazy', False)):
+            adjoint._set_up_from_description()
+            return getattr(self, name)
+        raise AttributeError("'{}' object has no attribute '{}'"
+                             "".format(type(self).__name__, name))
+
+
+class NormalProjectorByBinWrapper(Operator):
+
+    """The normal operator ``A^T A`` of a STIR projector ``A``.
+
+    The forward and back projections run back to back in STIR: the
+    intermediate projection data stays in the ``ProjDataInMemory`` of the
+    projector and is never copied to or from Python.
+    """
+
+    def __init__(self, projector):
+        """Initialize a new instance.
+
+        Parameters
+        ----------
+        projector : `ForwardProjectorByBinWrapper`
+            Projector ``A``, whose STIR projectors and buffers are used.
+            With a subset projector, only the views of the subset are
+            projected.
+        """
+        super().__init__(projector.domain, projector.domain, linear=True)
+        self.projector = projector
+
+    def _call(self, volume, out):
+        """Forward project then back project a volume."""
+        proj = self.projector
+        back = proj.adjoint
+        fill_stir_buffer(proj.volume, volume)
+        proj.projector.forward_project(proj.proj_data, proj.volume,
+                                       proj.subset_num, proj.num_subsets)
+        back.volume.fill(0)
+        back.back_projector.back_project(back.volume, back.proj_data,
+                                         back.subset_num, back.num_subsets)
+        read_stir_buffer(back.volume, out)
+
+    @property
+    def adjoint(self):
+        """The normal operator is self-adjoint."""
+        return self
+
+
+# Settings of the ray tracing projection matrix used by the projectors.
+# They are part of the key of a cached system matrix, see
+# `odlpet.stir.system_matrix`.
+PROJ_MATRIX_SETTINGS = {
+    'do_symmetry_90degrees_min_phi': True,
+    'do_symmetry_180degrees_min_phi': True,
+    'do_symmetry_swap_s': True,
+    'do_symmetry_swap_segment': True,
+    'num_tangential_LORs': 1,
+}
+
+
+def make_proj_matrix(proj_data_info, volume, restrict_to_cylindrical_FOV=True,
+                     settings=None):
+    """Create and set up a ``stir.ProjMatrixByBinUsingRayTracing``.
+
+    Parameters
+    ----------
+    proj_data_info : ``stir.ProjDataInfo``
+        Geometry of the projection data.
+    volume : ``stir.FloatVoxelsOnCartesianGrid``
+        Voxel grid of the image.
+    restrict_to_cylindrical_FOV : bool, optional
+    settings : dict, optional
+        Symmetries and number of tangential LORs,
+        defaults to `PROJ_MATRIX_SETTINGS`.
+    """
+    if settings is None:
+        settings = PROJ_MATRIX_SETTINGS
+    proj_matrix = ProjMatrixByBinUsingRayTracing()
+    for name, value in settings.items():
+        if name == 'num_tangential_LORs':
+            value = np.int32(value)
+        getattr(proj_matrix, 'set_' + name)(value)
+
+    proj_matrix.set_up(proj_data_info, volume)
 
-def call_with_stir_buffer(function, b_in, b_out, v_in, subset_num=0, num_subsets=1, clear_buffer=False):
-    b_in.fill(v_in.asarray().flat)
+    proj_matrix.set_restrict_to_cylindrical_FOV(restrict_to_cylindrical_FOV)
+    return proj_matrix
+
+
+# Number of floats transferred from STIR per ``np.fromiter`` call when reading
+# a buffer back; bounds the temporary memory used by `read_stir_buffer`.
+READ_CHUNK_SIZE = 2**20
+
+
+def fill_stir_buffer(stir_buffer, data):
+    """Fill a STIR container from an ODL element or array in one pass.
+
+    Parameters
+    ----------
+    stir_buffer : ``stir.FloatVoxelsOnCartesianGrid`` or ``stir.ProjData``
+        Container to fill.
+    data : `DiscreteLpElement` or `numpy.ndarray`
+        Values, in the same (C) order as the STIR container.
+        A contiguous float32 array (which is what ODL elements of our spaces
+        hold) is not copied on the NumPy side, but STIR still reads it
+        element by element through the ``flat`` iterator.
+    """
+    array = data if isinstance(data, np.ndarray) else data.asarray()
+    array = np.ascontiguousarray(array, dtype=np.float32)
+    stir_buffer.fill(array.flat)
+
+
+def read_stir_buffer(stir_buffer, out=None):
+    """Copy the content of a STIR container into a NumPy array.
+
+    Parameters
+    ----------
+    stir_buffer : ``stir.FloatVoxelsOnCartesianGrid`` or ``stir.ProjData``
+        Container to read.
+    out : `DiscreteLpElement` or `numpy.ndarray`, optional
+        Where to write the values. If its memory is a contiguous float32
+        buffer the values are written straight into it, otherwise they
+        are written into a temporary array first.
+
+    Returns
+    -------
+    out : `DiscreteLpElement` or `numpy.ndarray`
+        ``out`` if it was given, a new float32 array otherwise.
+    """
+    if isinstance(stir_buffer, ProjData):
+        stir_buffer = stir_buffer.to_array()
+    if out is None:
+        out = np.empty(tuple(stir_buffer.shape()), dtype=np.float32)
+    target = _writable_array(out)
+    if target is None:
+        out[:] = read_stir_buffer(stir_buffer)
+        return out
+    flat = target.reshape(-1)
+    stir_iter = stir_buffer.flat()
+    for start in range(0, flat.size, READ_CHUNK_SIZE):
+        stop = min(start + READ_CHUNK_SIZE, flat.size)
+        flat[start:stop] = np.fromiter(stir_iter, dtype=np.float32,
+                                       count=stop - start)
+    return out
+
+
+def _writable_array(x):
+    """Return the float32 C-contiguous memory of ``x``, or None."""
+    if isinstance(x, np.ndarray):
+        array = x
+    elif getattr(x.space, 'impl', None) == 'numpy':
+        # for NumPy-based ODL spaces this is the element's own storage
+        array = x.asarray()
+    else:
+        return None
+    if (array.dtype == np.float32 and array.flags.c_contiguous
+            and array.flags.writeable):
+        return array
+    return None
+
+
+def call_with_stir_buffer(function, b_in, b_out, v_in, subset_num=0, num_subsets=1, clear_buffer=False, out=None):
+    """Apply a STIR projection between two STIR buffers.
+
+    ``v_in`` is copied into ``b_in``, ``function(b_out, b_in, subset_num,
+    num_subsets)`` is called, and ``b_out`` is read into ``out`` (see
+    `read_stir_buffer`), which is returned.
+    """
+    fill_stir_buffer(b_in, v_in)
     if clear_buffer:
         b_out.fill(0)
     function(b_out, b_in, subset_num, num_subsets)
-    return to_numpy(b_out)
+    return read_stir_buffer(b_out, out)
+
+def projector_from_description(description):
+    """
+    Rebuild a projector from the `description` attribute of a projector
+    created by `Compression.get_projector`.
+    """
+    compression = description['compression']
+    return compression.get_projector(
+        stir_domain=stir_domain_from_parameters(description['domain']),
+        subset_num=description['subset_num'],
+        num_subsets=description['num_subsets'],
+        restrict_to_cylindrical_FOV=description['restrict_to_cylindrical_FOV'],
+        matrix_cache=description.get('matrix_cache'))
+
+
+def _subset_viewgrams(proj_data, subset_num, num_subsets):
+    """
+    Iterate over (sinogram slice, view index in subset, view number, segment)
+    for all the viewgrams of a subset.
+    """
+    proj_data_info = proj_data.get_proj_data_info()
+    info = get_sinogram_info(proj_data_info)
+    min_view = proj_data_info.get_min_view_num()
+    views = range(proj_data.get_num_views())[
+        get_subset_views(proj_data.get_num_views(), subset_num, num_subsets)]
+    for segment, num_axial in info:
+        start = get_offset(segment, 0, info)
+        sinograms = slice(start, start + num_axial)
+        for index, view in enumerate(views):
+            yield sinograms, index, min_view + view, segment
+
+
+def read_views(proj_data, subset_num, num_subsets, out):
+    """Read the views of a subset from ``proj_data`` into ``out``.
+
+    ``out`` has the layout of `get_range_from_proj_data` for the subset.
+    """
+    out_array = _writable_array(out)
+    target = np.empty(out.shape, dtype=np.float32) if out_array is None else out_array
+    for sinograms, index, view, segment in _subset_viewgrams(proj_data, subset_num, num_subsets):
+        target[sinograms, index, :] = read_stir_buffer(proj_data.get_viewgram(view, segment))
+    if out_array is None:
+        out[:] = target
+    return out
+
+
+def fill_views(proj_data, subset_num, num_subsets, data):
+    """Fill the views of a subset of ``proj_data`` from ``data``.
+
+    ``data`` has the layout of `get_range_from_proj_data` for the subset.
+    The views of the other subsets are left untouched.
+    """
+    array = data if isinstance(data, np.ndarray) else data.asarray()
+    for sinograms, index, view, segment in _subset_viewgrams(proj_data, subset_num, num_subsets):
+        viewgram = proj_data.get_empty_viewgram(view, segment)
+        fill_stir_buffer(viewgram, array[sinograms, index, :])
+        proj_data.set_viewgram(viewgram)
+
 
 def get_view_mask(forward_operator):
     """
     Return the view mask for a partial (view-subsampled) forward operator.
-    """
-    data = forward_operator(forward_operator.domain.one())
-    nb_tan = data.shape[-1]
-    mask = np.asarray(data[0,:,nb_tan//2]) > 0
-    return mask
 
+    The mask is computed from the subset rule (see `get_subset_views`),
+    without projecting anything.
+    """
+    num_views = forward_operator.proj_data.get_num_views()
+    return get_subset_view_mask(num_views, forward_operator.subset_num,
+                                forward_operator.num_subsets)
@@ -0,0 +1,334 @@
+"""
+Batched and parallel application of the STIR projectors.
+
+STIR projectors handle one volume or sinogram per call, on a single thread.
+`project_batch` applies a projector to a whole stack of inputs, reusing its
+STIR set-up and buffers, and optionally spreads the stack over worker
+processes (or threads), each of which rebuilds the projector once from its
+`description`. `ParallelForwardProjector` splits every single projection
+by subsets of views over a pool of worker processes.
+"""
+
+import threading
+import weakref
+from concurrent.futures import ThreadPoolExecutor
+from multiprocessing import Pool
+from multiprocessing.sharedctypes import RawArray
+
+import numpy as np
+
+from odl.operator import Operator
+
+from .bindings import (ForwardProjectorByBinWrapper,
+                       BackProjectorByBinWrapper,
+                       projector_from_description)
+from .system_matrix import SystemMatrixOperator
+from ..scanner.sinogram import get_subset_views
+
+
+def project_batch(operator, inputs, out=None, num_workers=1, use_threads=False):
+    """
+    Apply a STIR projector or back-projector to a stack of inputs.
+
+    Parameters
+    ----------
+    operator : `ForwardProjectorByBinWrapper`, `BackProjectorByBinWrapper` \
+            or `SystemMatrixOperator`
+    inputs : array-like
+        Array of shape ``(N,) + operator.domain.shape``, for instance
+        (N, z, y, x) volumes for a forward projector.
+    out : `numpy.ndarray`, optional
+        Float32 array of shape ``(N,) + operator.range.shape`` to write the
+        results into.
+    num_workers : int, optional
+        Number of workers. With one worker the stack is processed in this
+        process, with the STIR buffers of ``operator``. A
+        `SystemMatrixOperator` always works in this process, with that many
+        threads.
+    use_threads : bool, optional
+        Use threads instead of processes. Each thread has its own STIR
+        projector, so threads only run concurrently if the STIR bindings
+        release the GIL.
+
+    Returns
+    -------
+    out : `numpy.ndarray`
+    """
+    inputs = np.asarray(inputs, dtype=np.float32)
+    if inputs.shape[1:] != operator.domain.shape:
+        raise ValueError('inputs shape {} does not match (N,) + {}'
+                         ''.format(inputs.shape, operator.domain.shape))
+    if out is None:
+        out = np.empty((len(inputs),) + operator.range.shape, dtype=np.float32)
+    elif out.shape != (len(inputs),) + operator.range.shape:
+        raise ValueError('out shape {} does not match ({},) + {}'
+                         ''.format(out.shape, len(inputs), operator.range.shape))
+
+    if isinstance(operator, SystemMatrixOperator):
+        # sparse products with all the inputs as right-hand sides
+        return operator.apply_batch(inputs, out=out, num_threads=num_workers)
+
+    if num_workers == 1 or len(inputs) <= 1:
+        _apply(operator, inputs, out)
+        return out
+
+    description, adjoint = _get_description(operator)
+    chunks = np.array_split(np.arange(len(inputs)), min(num_workers, len(inputs)))
+    if use_threads:
+        local = threading.local()
+
+        def work(indices):
+            if not hasattr(local, 'operator'):
+                local.operator = _rebuild(description, adjoint)
+            _apply(local.operator, inputs[indices], out[indices[0]:indices[-1]+1])
+
+        with ThreadPoolExecutor(num_workers) as executor:
+            list(executor.map(work, chunks))
+    else:
+        with Pool(num_workers, initializer=_init_worker,
+                  initargs=(description, adjoint)) as pool:
+            results = pool.map(_apply_in_worker, [inputs[indices] for indices in chunks])
+        for indices, result in zip(chunks, results):
+            out[indices] = result
+    return out
+
+
+def _apply(operator, inputs, out):
+    """Apply the operator to each input, writing straight into ``out``."""
+    for x, y in zip(inputs, out):
+        operator._call(x, y)
+
+
+def _get_description(operator):
+    """Description of the forward projector, and whether to take its adjoint."""
+    if isinstance(operator, BackProjectorByBinWrapper):
+        forward, adjoint = operator.adjoint, True
+    elif isinstance(operator, ForwardProjectorByBinWrapper):
+        forward, adjoint = operator, False
+    else:
+        raise TypeError('Expected a STIR projector or back-projector, got {}'
+                        ''.format(type(operator)))
+    if forward.description is None:
+        raise ValueError('Parallel projection needs a projector created by '
+                         'Compression.get_projector without stir_proj_data_info')
+    return forward.description, adjoint
+
+
+def _rebuild(description, adjoint):
+    proj = projector_from_description(description)
+    return proj.adjoint if adjoint else proj
+
+
+# projector of a worker process, set by `_init_worker`
+_worker_operator = None
+
+
+def _init_worker(description, adjoint):
+    global _worker_operator
+    _worker_operator = _rebuild(description, adjoint)
+
+
+def _apply_in_worker(inputs):
+    out = np.empty((len(inputs),) + _worker_operator.range.shape, dtype=np.float32)
+    _apply(_worker_operator, inputs, out)
+    return out
+
+
+class ParallelProjectionEngine:
+    """
+    Pool of worker processes splitting projections by subset of views.
+
+    Each worker holds its own set-up STIR projector, rebuilt from the
+    `description` of a projector created by `Compression.get_projector`.
+    The input volume, the projection data and one back-projected volume per
+    subset live in shared memory, so only subset indices are sent to the
+    workers. Subset ``k`` of a forward projection writes its own views of
+    the shared projection data; the back-projected volumes of the subsets
+    are summed at the end.
+    """
+
+    def __init__(self, proj, num_workers, num_parts=None):
+        """
+        proj: a full `ForwardProjectorByBinWrapper` with a description.
+        num_workers: number of worker processes.
+        num_parts: number of subsets the projections are split into,
+        defaults to ``num_workers``.
+        """
+        description, _ = _get_description(proj)
+        if proj.num_subsets != 1:
+            raise ValueError('The parallel engine needs a projector on all views')
+        if num_parts is None:
+            num_parts = num_workers
+        num_views = proj.range.shape[1]
+        if not 1 <= num_parts <= num_views:
+            raise ValueError('Cannot split {} views into {} parts'.format(num_views, num_parts))
+        self.description = description
+        self.num_workers = num_workers
+        self.num_parts = num_parts
+        self.volume_shape = proj.domain.shape
+        self.data_shape = proj.range.shape
+        self.volume = _SharedArray(self.volume_shape)
+        self.data = _SharedArray(self.data_shape)
+        self.back_volumes = _SharedArray((num_parts,) + self.volume_shape)
+        self._pool = None
+        self._finalizer = None
+
+    @property
+    def pool(self):
+        """
+        The worker pool, started on first use. It is terminated when the
+        engine is garbage collected without having been closed.
+        """
+        if self._pool is None:
+            self._pool = Pool(self.num_workers, initializer=_init_engine_worker,
+                              initargs=(self.description, self.num_parts,
+                                        self.volume, self.data, self.back_volumes))
+            self._finalizer = weakref.finalize(self, self._pool.terminate)
+        return self._pool
+
+    @property
+    def worker_pids(self):
+        """Process ids of the running workers, empty if the pool is not started."""
+        if self._pool is None:
+            return []
+        return [process.pid for process in self._pool._pool]
+
+    def close(self):
+        """Stop the worker processes."""
+        if self._pool is not None:
+            self._finalizer.detach()
+            self._pool.close()
+            self._pool.join()
+            self._pool = None
+            self._finalizer = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def forward(self, volume, out):
+        np.copyto(self.volume.array, volume)
+        self.pool.map(_forward_part, range(self.num_parts))
+        out[:] = self.data.array
+
+    def back(self, projections, out):
+        np.copyto(self.data.array, projections)
+        self.pool.map(_back_part, range(self.num_parts))
+        out[:] = np.sum(self.back_volumes.array, axis=0)
+
+
+class _SharedArray:
+    """A float32 array in shared memory, passed to the workers at start."""
+
+    def __init__(self, shape):
+        self.shape = tuple(shape)
+        self.buffer = RawArray('f', int(np.prod(self.shape)))
+
+    @property
+    def array(self):
+        return np.frombuffer(self.buffer, dtype=np.float32).reshape(self.shape)
+
+
+class ParallelForwardProjector(Operator):
+
+    """A forward projector computing subsets of views in worker processes."""
+
+    def __init__(self, proj, num_workers, num_parts=None, engine=None):
+        """Initialize a new instance.
+
+        Parameters
+        ----------
+        proj : `ForwardProjectorByBinWrapper`
+            Projector on all views, created by `Compression.get_projector`.
+            It gives the domain, range and description of the workers'
+            projectors.
+        num_workers : int
+            Number of worker processes.
+        num_parts : int, optional
+            Number of subsets each projection is split into,
+            defaults to ``num_workers``.
+        engine : `ParallelProjectionEngine`, optional
+            A pre-initialized engine, shared with the adjoint.
+        """
+        super().__init__(proj.domain, proj.range, linear=True)
+        if engine is None:
+            engine = ParallelProjectionEngine(proj, num_workers, num_parts)
+        self.engine = engine
+        self._adjoint = ParallelBackProjector(self)
+
+    def _call(self, volume, out):
+        """Forward project a volume."""
+        self.engine.forward(volume.asarray(), out)
+
+    @property
+    def adjoint(self):
+        """Back-projector associated with this operator."""
+        return self._adjoint
+
+    def close(self):
+        """Stop the worker processes."""
+        self.engine.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class ParallelBackProjector(Operator):
+
+    """A back-projector computing subsets of views in worker processes."""
+
+    def __init__(self, adjoint):
+        """
+        adjoint: the `ParallelForwardProjector` whose engine is used.
+        """
+        super().__init__(adjoint.range, adjoint.domain, linear=True)
+        self.engine = adjoint.engine
+        self._adjoint = adjoint
+
+    def _call(self, projections, out):
+        """Back project."""
+        self.engine.back(projections.asarray(), out)
+
+    @property
+    def adjoint(self):
+        """Forward projector associated with this operator."""
+        return self._adjoint
+
+
+# state of an engine worker process, set by `_init_engine_worker`
+_engine_state = {}
+
+
+def _init_engine_worker(description, num_parts, volume, data, back_volumes):
+    proj = projector_from_description(description)
+    subsets = [proj.get_subset(k, num_parts) for k in range(num_parts)]
+    _engine_state.update(
+        subsets=subsets,
+        views=[get_subset_views(proj.range.shape[1], k, num_parts)
+               for k in range(num_parts)],
+        # the views of a subset are strided in the shared data, the STIR
+        # projectors read and write them through a contiguous copy
+        parts=[np.empty(subset.range.shape, dtype=np.float32) for subset in subsets],
+        volume=volume.array,
+        data=data.array,
+        back_volumes=back_volumes.array,
+    )
+
+
+def _forward_part(k):
+    state = _engine_state
+    part = state['parts'][k]
+    state['subsets'][k]._call(state['volume'], part)
+    state['data'][:, state['views'][k], :] = part
+
+
+def _back_part(k):
+    state = _engine_state
+    part = state['parts'][k]
+    np.copyto(part, state['data'][:, state['views'][k], :])
+    state['subsets'][k].adjoint._call(part, state['back_volumes'][k])
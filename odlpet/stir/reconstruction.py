@@ -0,0 +1,363 @@
+"""
+MLEM and OSEM reconstruction with the STIR projectors.
+
+`osem` follows `odl.solvers.osmlem`, but works on the float32 arrays of
+the iterate and of preallocated buffers: every sub-iteration is one
+forward and one back projection through the STIR buffers of the
+projectors, followed by in-place NumPy updates. The sensitivity images
+``A_k^T 1`` of the subsets are computed once and can be kept in a
+`SensitivityCache`, in memory or on disk.
+
+`reconstruct_planes` reconstructs direct (segment 0) sinograms plane by
+plane with a 2D projector, spreading the planes over worker processes.
+"""
+
+import copy
+import hashlib
+import os
+import tempfile
+import time
+import tracemalloc
+
+from multiprocessing import Pool
+
+import numpy as np
+
+from .bindings import _writable_array
+from .space import (space_from_stir_domain, stir_domain_parameters,
+                    stir_domain_from_parameters)
+from .system_matrix import system_matrix_key
+from ..scanner.sinogram import get_subset_views
+
+try:
+    import resource
+except ImportError:  # not available on Windows
+    resource = None
+
+
+# Lower bound of the estimated projections and of the sensitivities,
+# as in odl.solvers.osmlem
+EPS = 1e-8
+
+
+def sensitivity_key(projector):
+    """
+    Hash identifying the sensitivity image of a projector, or None.
+
+    Only projectors with a `description` (see `Compression.get_projector`)
+    have a key.
+    """
+    description = getattr(projector, 'description', None)
+    if description is None:
+        return None
+    compression = description['compression']
+    stir_domain = stir_domain_from_parameters(description['domain'])
+    matrix_key = system_matrix_key(
+        compression, stir_domain, compression.get_stir_proj_data_info(),
+        restrict_to_cylindrical_FOV=description['restrict_to_cylindrical_FOV'])
+    subset = '{}/{}'.format(description['subset_num'], description['num_subsets'])
+    return hashlib.sha1((matrix_key + subset).encode('utf-8')).hexdigest()
+
+
+class SensitivityCache:
+    """
+    Sensitivity images ``A^T 1``, kept in memory and optionally on disk.
+
+    On disk, each image is a ``.npy`` file named by its key
+    (see `sensitivity_key`).
+    """
+
+    def __init__(self, directory=None):
+        """
+        directory: where to store the images, created if needed.
+        Without a directory the images are only kept in memory.
+        """
+        self.images = {}
+        if directory is not None:
+            directory = os.path.abspath(os.path.expanduser(directory))
+            os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+
+    def _path(self, key):
+        return os.path.join(self.directory, key + '.npy')
+
+    def get(self, key, compute):
+        """
+        Sensitivity image stored under ``key``, computed with ``compute()``
+        and stored if missing. A ``key`` of None is never cached.
+        """
+        if key is None:
+            return compute()
+        if key in self.images:
+            return self.images[key]
+        image = None
+        if self.directory is not None:
+            try:
+                image = np.load(self._path(key))
+            except FileNotFoundError:
+                pass
+        if image is None:
+            image = compute()
+            if self.directory is not None:
+                self._store(key, image)
+        self.images[key] = image
+        return image
+
+    def _store(self, key, image):
+        fid, tmp = tempfile.mkstemp(prefix='.tmp-', suffix='.npy', dir=self.directory)
+        try:
+            with os.fdopen(fid, 'wb') as f:
+                np.save(f, image)
+            os.replace(tmp, self._path(key))
+        except OSError:
+            os.remove(tmp)
+            raise
+
+
+def compute_sensitivity(projector):
+    """The sensitivity image ``A^T 1`` of a projector, as a float32 array."""
+    ones = np.ones(projector.range.shape, dtype=np.float32)
+    out = np.empty(projector.domain.shape, dtype=np.float32)
+    projector.adjoint._call(ones, out)
+    return out
+
+
+def get_sensitivities(projectors, cache=None):
+    """
+    Sensitivity images of the projectors, from ``cache`` when possible.
+
+    cache: a `SensitivityCache`, or a directory for one.
+    """
+    if cache is None:
+        cache = SensitivityCache()
+    elif not isinstance(cache, SensitivityCache):
+        cache = SensitivityCache(cache)
+    return [cache.get(sensitivity_key(proj), lambda: compute_sensitivity(proj))
+            for proj in projectors]
+
+
+def osem(projectors, x, data, niter, callback=None, sensitivities=None,
+         sensitivity_cache=None, report=None):
+    """
+    Ordered subsets expectation maximisation.
+
+    Parameters
+    ----------
+    projectors : sequence of `ForwardProjectorByBinWrapper` or `SystemMatrixOperator`
+        Projectors of the subsets, for instance from `Compression.get_projectors`.
+    x : ``projectors[0].domain`` element
+        Non-negative starting point, updated in place.
+    data : sequence of array-like
+        Projection data of each subset, in the range of its projector.
+    niter : int
+        Number of iterations, each going through all the subsets.
+    callback : callable, optional
+        Called with ``x`` after each sub-iteration, as in ODL solvers.
+    sensitivities : sequence of array-like, optional
+        Sensitivity images ``A_k^T 1``. Default: computed with
+        `get_sensitivities`.
+    sensitivity_cache : `SensitivityCache` or str, optional
+        Cache (or cache directory) for the sensitivity images.
+    report : callable, optional
+        Called after each iteration with a dict holding the ``iteration``
+        number, its wall ``time`` and the ``subset_times`` in seconds, the
+        peak resident memory of the process ``peak_rss`` in bytes (None
+        where unavailable) and, if `tracemalloc` is tracing, the peak of
+        traced memory during the iteration ``peak_traced`` in bytes (since
+        tracing started, before Python 3.9).
+    """
+    if len(data) != len(projectors):
+        raise ValueError('number of data ({}) does not match number of '
+                         'projectors ({})'.format(len(data), len(projectors)))
+    data = [np.asarray(d, dtype=np.float32) for d in data]
+    for proj, d in zip(projectors, data):
+        if d.shape != proj.range.shape:
+            raise ValueError('data shape {} does not match {}'
+                             ''.format(d.shape, proj.range.shape))
+
+    # iterate on the memory of x when possible, otherwise on a copy
+    x_arr = _writable_array(x)
+    copy_back = x_arr is None
+    if copy_back:
+        x_arr = np.asarray(x, dtype=np.float32).copy()
+    if np.any(x_arr < 0):
+        raise ValueError('`x` must be non-negative')
+
+    if sensitivities is None:
+        sensitivities = get_sensitivities(projectors, sensitivity_cache)
+    # the updates multiply by the inverse sensitivities
+    inv_sensitivities = []
+    for sens in sensitivities:
+        inv = np.maximum(np.asarray(sens, dtype=np.float32), EPS)
+        np.reciprocal(inv, out=inv)
+        inv_sensitivities.append(inv)
+
+    volume_buffer = np.empty(x_arr.shape, dtype=np.float32)
+    data_buffers = [np.empty(d.shape, dtype=np.float32) for d in data]
+
+    for iteration in range(niter):
+        # the peak can only be reset from Python 3.9
+        if tracemalloc.is_tracing() and hasattr(tracemalloc, 'reset_peak'):
+            tracemalloc.reset_peak()
+        start = time.perf_counter()
+        subset_times = []
+        for proj, d, ratio, inv in zip(projectors, data, data_buffers,
+                                       inv_sensitivities):
+            subset_start = time.perf_counter()
+            proj._call(x_arr, ratio)
+            np.maximum(ratio, EPS, out=ratio)
+            np.divide(d, ratio, out=ratio)
+            proj.adjoint._call(ratio, volume_buffer)
+            volume_buffer *= inv
+            x_arr *= volume_buffer
+            subset_times.append(time.perf_counter() - subset_start)
+            if copy_back:
+                x[:] = x_arr
+            if callback is not None:
+                callback(x)
+        if report is not None:
+            report({
+                'iteration': iteration,
+                'time': time.perf_counter() - start,
+                'subset_times': subset_times,
+                'peak_rss': _peak_rss(),
+                'peak_traced': (tracemalloc.get_traced_memory()[1]
+                                if tracemalloc.is_tracing() else None),
+            })
+    return x
+
+
+def mlem(projector, x, data, niter, callback=None, sensitivity=None,
+         sensitivity_cache=None, report=None):
+    """
+    Maximum likelihood expectation maximisation, see `osem`.
+    """
+    sensitivities = None if sensitivity is None else [sensitivity]
+    return osem([projector], x, [data], niter, callback=callback,
+                sensitivities=sensitivities,
+                sensitivity_cache=sensitivity_cache, report=report)
+
+
+def get_plane_compression(compression):
+    """
+    Compression of a single direct plane of the scanner of ``compression``,
+    with the same views and tangential positions.
+    """
+    plane = copy.deepcopy(compression)
+    scanner = plane.scanner
+    scanner.num_rings = 1
+    # a single ring has no axial block structure
+    scanner.axials_blocks_per_bucket = 0
+    scanner.axial_crystals_per_block = 0
+    scanner.axial_crystals_per_singles_unit = -1
+    plane.span_num = 1
+    plane.max_diff_ring = 0
+    return plane
+
+
+def reconstruct_planes(compression, data, niter, stir_domain=None, num_subsets=1,
+                       num_workers=1, restrict_to_cylindrical_FOV=True):
+    """
+    Reconstruct direct sinograms plane by plane with OSEM.
+
+    Every sinogram of a segment 0 compression (for instance the target of
+    `get_ssrb`) is an independent 2D problem. All the planes share one 2D
+    projector, built from `get_plane_compression`, and are reconstructed
+    in ``num_workers`` processes. The plane images are then interpolated
+    along z onto the slices of the 3D domain.
+
+    Parameters
+    ----------
+    compression : `Compression`
+        Compression with only segment 0.
+    data : array-like
+        Projection data of shape (sinograms, views, tangential).
+    niter : int
+        Number of OSEM iterations of each plane.
+    stir_domain : ``stir.FloatVoxelsOnCartesianGrid``, optional
+        3D domain of the result, defaults to ``compression.get_stir_domain()``.
+    num_subsets : int, optional
+    num_workers : int, optional
+        Number of processes. With one worker, the planes are reconstructed
+        in this process.
+    restrict_to_cylindrical_FOV : bool, optional
+
+    Returns
+    -------
+    volume : element of ``space_from_stir_domain(stir_domain)``
+    """
+    info = compression._get_sinogram_info()
+    if [segment for (segment, _) in info] != [0]:
+        raise ValueError('Plane reconstruction needs data with only segment 0, '
+                         'see get_ssrb')
+    data = np.asarray(data, dtype=np.float32)
+    if stir_domain is None:
+        stir_domain = compression.get_stir_domain()
+    parameters = stir_domain_parameters(stir_domain)
+
+    # the 2D domain has the (y, x) grid of the 3D domain and a single slice
+    plane_parameters = copy.deepcopy(parameters)
+    plane_parameters['min_indices'][0] = plane_parameters['max_indices'][0] = 0
+    plane_parameters['origin'][0] = 0.
+    plane_compression = get_plane_compression(compression)
+    projectors, _ = plane_compression.get_projectors(
+        num_subsets=num_subsets,
+        stir_domain=stir_domain_from_parameters(plane_parameters),
+        restrict_to_cylindrical_FOV=restrict_to_cylindrical_FOV)
+    sensitivities = get_sensitivities(projectors)
+
+    if num_workers == 1:
+        _init_plane_worker(projectors, sensitivities, niter)
+        planes = [_reconstruct_plane(sinogram) for sinogram in data]
+    else:
+        with Pool(num_workers, initializer=_init_plane_worker,
+                  initargs=(projectors, sensitivities, niter)) as pool:
+            planes = pool.map(_reconstruct_plane, data)
+
+    space = space_from_stir_domain(stir_domain)
+    return space.element(_interpolate_planes(np.array(planes), compression, parameters))
+
+
+def _interpolate_planes(planes, compression, parameters):
+    """Linear interpolation along z of the plane images onto the slices."""
+    # direct sinograms are sampled at the ring spacing with span 1, and at
+    # half of it otherwise
+    spacing = compression.scanner.ring_spacing
+    if compression.span_num > 1:
+        spacing = spacing / 2
+    plane_z = np.arange(len(planes)) * spacing
+    slices = np.arange(parameters['min_indices'][0], parameters['max_indices'][0] + 1)
+    slice_z = parameters['origin'][0] + slices * parameters['voxel_size'][0]
+    position = np.clip(np.interp(slice_z, plane_z, np.arange(len(planes))), 0, len(planes) - 1)
+    lower = np.floor(position).astype(int)
+    upper = np.minimum(lower + 1, len(planes) - 1)
+    weight = (position - lower).astype(np.float32)[:, None, None]
+    return (1 - weight) * planes[lower] + weight * planes[upper]
+
+
+# projectors of a plane worker process, set by `_init_plane_worker`
+_plane_state = {}
+
+
+def _init_plane_worker(projectors, sensitivities, niter):
+    _plane_state.update(projectors=projectors, sensitivities=sensitivities, niter=niter)
+
+
+def _reconstruct_plane(sinogram):
+    """OSEM reconstruction of one (views, tangential) sinogram."""
+    projectors = _plane_state['projectors']
+    num_views = sinogram.shape[0]
+    data = [sinogram[None, get_subset_views(num_views, proj.subset_num, proj.num_subsets)]
+            for proj in projectors]
+    x = np.ones(projectors[0].domain.shape, dtype=np.float32)
+    osem(projectors, x, data, _plane_state['niter'],
+         sensitivities=_plane_state['sensitivities'])
+    return x[0]
+
+
+def _peak_rss():
+    """Peak resident memory of this process in bytes, or None."""
+    if resource is None:
+        return None
+    # kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
@@ -1,4 +1,8 @@
 from odl.discr import uniform_discr
+from stir import (FloatCartesianCoordinate3D,
+                  IntCartesianCoordinate3D,
+                  IndexRange3D,
+                  FloatVoxelsOnCartesianGrid)
 
 def space_from_stir_domain(stir_domain):
     """
@@ -32,3 +36,29 @@ def space_from_stir_domain(stir_domain):
         min_pt=vol_min, max_pt=vol_max, shape=vox_num,
         axis_labels=["z", "y", "x"],
         dtype='float32')
+
+def stir_domain_parameters(stir_domain):
+    """
+    Describe a VoxelsOnCartesianGrid by plain Python values.
+
+    Returns a dictionary with the minimum and maximum indices,
+    the voxel size and the origin, all in STIR (z, y, x) order.
+    """
+    def as_list(coord, convert):
+        return [convert(coord[i]) for i in (1, 2, 3)]
+    return {
+        'min_indices': as_list(stir_domain.get_min_indices(), int),
+        'max_indices': as_list(stir_domain.get_max_indices(), int),
+        'voxel_size': as_list(stir_domain.get_voxel_size(), float),
+        'origin': as_list(stir_domain.get_origin(), float),
+    }
+
+def stir_domain_from_parameters(parameters):
+    """
+    Create a VoxelsOnCartesianGrid from its `stir_domain_parameters`.
+    """
+    index_range = IndexRange3D(IntCartesianCoordinate3D(*parameters['min_indices']),
+                               IntCartesianCoordinate3D(*parameters['max_indices']))
+    return FloatVoxelsOnCartesianGrid(index_range,
+                                      FloatCartesianCoordinate3D(*parameters['origin']),
+                                      FloatCartesianCoordinate3D(*parameters['voxel_size']))
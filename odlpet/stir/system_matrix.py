@@ -0,0 +1,464 @@
+"""
+Persistent cache of the ray tracing system matrix.
+
+STIR computes the elements of ``ProjMatrixByBinUsingRayTracing`` lazily,
+during the first projections, and does so again in every process.
+The functions here walk the whole matrix once, store it on disk in
+compressed sparse row (CSR) form under a key computed from the geometry,
+and memory-map it in later processes.
+
+Rows of the matrix follow the layout of `get_range_from_proj_data`
+(sinograms in segment order 0, +1, -1, ..., then views, then tangential
+positions) and columns the (z, y, x) layout of `space_from_stir_domain`.
+"""
+
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import scipy.sparse
+
+from stir import Bin, ProjMatrixElemsForOneBin
+
+from odl.operator import Operator
+
+from .bindings import (PROJ_MATRIX_SETTINGS, make_proj_matrix,
+                       projector_from_description)
+from .space import stir_domain_parameters
+from ..scanner.scanner import ACCESSOR_MAPPING
+from ..scanner.sinogram import (get_sinogram_info, get_segment_sinograms,
+                                get_subset_views, segment_reordered_)
+
+
+def system_matrix_key(compression, stir_domain, proj_data_info,
+                      restrict_to_cylindrical_FOV=True, settings=None):
+    """
+    Hash identifying a system matrix.
+
+    Parameters
+    ----------
+    compression : `Compression`
+    stir_domain : ``stir.FloatVoxelsOnCartesianGrid``
+    proj_data_info : ``stir.ProjDataInfo``
+        Geometry of the projection data. Its sinogram layout is part of
+        the key, which matters when it does not come from ``compression``.
+    restrict_to_cylindrical_FOV : bool, optional
+    settings : dict, optional
+        Symmetries and number of tangential LORs,
+        defaults to `PROJ_MATRIX_SETTINGS`.
+
+    Returns
+    -------
+    key : str
+        Hexadecimal SHA-1 digest.
+    """
+    if settings is None:
+        settings = PROJ_MATRIX_SETTINGS
+    stir_scanner = proj_data_info.get_scanner()
+    description = {
+        'scanner': {pa: float(getattr(stir_scanner, "get_"+sa)())
+                    for (sa, pa, ty) in ACCESSOR_MAPPING},
+        'span_num': int(compression.span_num),
+        'max_diff_ring': int(compression.max_diff_ring),
+        'data_arc_corrected': bool(compression.data_arc_corrected),
+        'sinograms': get_sinogram_info(proj_data_info),
+        'num_views': proj_data_info.get_num_views(),
+        'num_tangential': proj_data_info.get_num_tangential_poss(),
+        'domain': stir_domain_parameters(stir_domain),
+        'restrict_to_cylindrical_FOV': bool(restrict_to_cylindrical_FOV),
+        'settings': {name: (value if isinstance(value, bool) else float(value))
+                     for name, value in settings.items()},
+    }
+    encoded = json.dumps(description, sort_keys=True).encode('utf-8')
+    return hashlib.sha1(encoded).hexdigest()
+
+
+def compute_system_matrix(proj_matrix, proj_data_info, stir_domain,
+                          segments=None, subset_num=0, num_subsets=1):
+    """
+    Compute the system matrix by walking all the bins of the projection data.
+
+    This traces every ray, so it is slow; see `SystemMatrixCache`.
+    The matrix is stored fully expanded, without the symmetries STIR uses
+    internally, so its size grows with the number of bins times the
+    length of the rays: meant for reduced geometries (a few segments, a
+    subset of views, direct sinograms after SSRB, a coarse image), not
+    for the 3D data of a whole clinical scanner.
+
+    Parameters
+    ----------
+    proj_matrix : ``stir.ProjMatrixByBin``
+        A set up projection matrix.
+    proj_data_info : ``stir.ProjDataInfo``
+    stir_domain : ``stir.FloatVoxelsOnCartesianGrid``
+    segments : sequence of int, optional
+        Only compute the rows of the sinograms of these segments.
+        Defaults to all segments.
+    subset_num, num_subsets : int, optional
+        Only compute the rows of the views of a subset,
+        see `get_subset_views`.
+
+    Returns
+    -------
+    matrix : `scipy.sparse.csr_matrix`
+        Float32 matrix of shape (number of bins, number of voxels).
+        The rows follow the layout of the projection data restricted to
+        the chosen segments and views.
+    """
+    domain = stir_domain_parameters(stir_domain)
+    lo = domain['min_indices']
+    shape = [high + 1 - low for (low, high) in zip(lo, domain['max_indices'])]
+
+    info = get_sinogram_info(proj_data_info)
+    if segments is None:
+        segments = [segment for (segment, _) in info]
+    min_view = proj_data_info.get_min_view_num()
+    views = range(min_view, proj_data_info.get_max_view_num() + 1)
+    views = views[get_subset_views(len(views), subset_num, num_subsets)]
+    tangs = range(proj_data_info.get_min_tangential_pos_num(),
+                  proj_data_info.get_max_tangential_pos_num() + 1)
+
+    elems = ProjMatrixElemsForOneBin()
+    counts = []
+    indices = []
+    data = []
+    for segment in sorted(set(segments), key=segment_reordered_):
+        for axial in range(proj_data_info.get_min_axial_pos_num(segment),
+                           proj_data_info.get_max_axial_pos_num(segment) + 1):
+            for view in views:
+                for tang in tangs:
+                    proj_matrix.get_proj_matrix_elems_for_one_bin(
+                        elems, Bin(segment, view, axial, tang))
+                    columns, values = _bin_elements(elems, lo, shape)
+                    indices.append(columns)
+                    data.append(values)
+                    counts.append(len(values))
+
+    num_cols = int(np.prod(shape))
+    nnz = int(np.sum(counts))
+    index_dtype = _index_dtype(nnz, num_cols)
+    indptr = np.zeros(len(counts) + 1, dtype=index_dtype)
+    np.cumsum(counts, out=indptr[1:])
+    return scipy.sparse.csr_matrix(
+        (np.concatenate(data) if data else np.zeros(0, dtype=np.float32),
+         np.concatenate(indices).astype(index_dtype) if indices else np.zeros(0, dtype=index_dtype),
+         indptr),
+        shape=(len(counts), num_cols))
+
+
+def _bin_elements(elems, lo, shape):
+    """
+    Columns and values of the elements of one bin, as arrays.
+
+    The STIR bindings have no bulk accessor for the elements of a bin, so
+    they are still read one by one, in a single pass; only the column
+    indices are then computed on the whole bin at once. Elements outside
+    the image (which STIR may keep for its axial symmetries) are dropped.
+    """
+    items = np.array([(c[1], c[2], c[3], elem.get_value())
+                      for elem in elems for c in (elem.get_coords(),)],
+                     dtype=np.float64).reshape(-1, 4)
+    coords = items[:, :3].astype(np.int64) - lo
+    inside = np.all((coords >= 0) & (coords < shape), axis=1)
+    coords = coords[inside]
+    columns = (coords[:, 0] * shape[1] + coords[:, 1]) * shape[2] + coords[:, 2]
+    return columns, items[inside, 3].astype(np.float32)
+
+
+def select_rows(matrix, proj_data_info, segments=None, subset_num=0, num_subsets=1):
+    """
+    Rows of a full system matrix belonging to some segments and a subset
+    of views, in the order `compute_system_matrix` computes them.
+    """
+    info = get_sinogram_info(proj_data_info)
+    shape = (sum(size for (_, size) in info),
+             proj_data_info.get_num_views(),
+             proj_data_info.get_num_tangential_poss())
+    if segments is None and num_subsets == 1:
+        return matrix
+    if segments is None:
+        sinograms = slice(None)
+    else:
+        sinograms = get_segment_sinograms(info, segments)
+    views = get_subset_views(shape[1], subset_num, num_subsets)
+    rows = np.arange(np.prod(shape)).reshape(shape)[sinograms][:, views, :]
+    return matrix[rows.ravel()]
+
+
+def _index_dtype(nnz, num_cols):
+    """Smallest index type that SciPy keeps as is for a CSR matrix."""
+    if max(nnz, num_cols) < np.iinfo(np.int32).max:
+        return np.int32
+    return np.int64
+
+
+class SystemMatrixCache:
+    """
+    Directory of system matrices, memory-mapped when loaded.
+
+    Each matrix is stored in a subdirectory named by its key
+    (see `system_matrix_key`), as the ``.npy`` arrays of its CSR
+    representation. Whenever a matrix is stored and the cache exceeds
+    ``max_bytes``, the least recently used matrices are removed.
+    """
+
+    _ARRAYS = ('data', 'indices', 'indptr')
+
+    def __init__(self, directory, max_bytes=None):
+        """
+        directory: where to store the matrices, created if needed.
+        max_bytes: size limit of the cache, or None for no limit.
+        """
+        self.directory = os.path.abspath(os.path.expanduser(directory))
+        self.max_bytes = max_bytes
+        os.makedirs(self.directory, exist_ok=True)
+
+    def _path(self, key):
+        return os.path.join(self.directory, key)
+
+    def load(self, key):
+        """
+        Memory-map the matrix stored under ``key``, or return None.
+        """
+        path = self._path(key)
+        try:
+            with open(os.path.join(path, 'shape.json')) as fid:
+                shape = tuple(json.load(fid))
+            arrays = [np.load(os.path.join(path, name + '.npy'), mmap_mode='r')
+                      for name in self._ARRAYS]
+        except FileNotFoundError:
+            return None
+        # the modification time of the directory records the last use
+        os.utime(path)
+        return scipy.sparse.csr_matrix(tuple(arrays), shape=shape, copy=False)
+
+    def store(self, key, matrix):
+        """
+        Store a CSR matrix under ``key``, then apply the size limit.
+        """
+        tmp = tempfile.mkdtemp(prefix='.tmp-', dir=self.directory)
+        try:
+            for name in self._ARRAYS:
+                np.save(os.path.join(tmp, name + '.npy'), getattr(matrix, name))
+            with open(os.path.join(tmp, 'shape.json'), 'w') as fid:
+                json.dump(list(matrix.shape), fid)
+            os.rename(tmp, self._path(key))
+        except OSError:
+            shutil.rmtree(tmp, ignore_errors=True)
+            # another process may have stored the same matrix meanwhile
+            if not os.path.isdir(self._path(key)):
+                raise
+        self.evict(keep=key)
+
+    def get(self, key, compute):
+        """
+        Load the matrix stored under ``key``, computing and storing it
+        with ``compute()`` if it is not in the cache.
+        """
+        matrix = self.load(key)
+        if matrix is None:
+            self.store(key, compute())
+            matrix = self.load(key)
+        return matrix
+
+    def _entries(self):
+        """List of (last use, size in bytes, key) of the stored matrices."""
+        entries = []
+        for key in os.listdir(self.directory):
+            path = self._path(key)
+            if key.startswith('.') or not os.path.isdir(path):
+                continue
+            size = sum(os.path.getsize(os.path.join(path, name))
+                       for name in os.listdir(path))
+            entries.append((os.path.getmtime(path), size, key))
+        return entries
+
+    def size(self):
+        """Total size of the stored matrices in bytes."""
+        return sum(size for (_, size, _) in self._entries())
+
+    def evict(self, keep=None):
+        """
+        Remove least recently used matrices until the cache fits in
+        ``max_bytes``. The matrix stored under ``keep`` is never removed.
+        """
+        if self.max_bytes is None:
+            return
+        entries = sorted(self._entries())
+        total = sum(size for (_, size, _) in entries)
+        for (_, size, key) in entries:
+            if total <= self.max_bytes:
+                break
+            if key == keep:
+                continue
+            shutil.rmtree(self._path(key), ignore_errors=True)
+            total -= size
+
+
+def get_system_matrix(compression, stir_domain, proj_data_info, cache=None,
+                      restrict_to_cylindrical_FOV=True, settings=None,
+                      segments=None, subset_num=0, num_subsets=1):
+    """
+    System matrix of a geometry, from the cache if possible.
+
+    Parameters
+    ----------
+    compression : `Compression`
+    stir_domain : ``stir.FloatVoxelsOnCartesianGrid``
+    proj_data_info : ``stir.ProjDataInfo``
+    cache : `SystemMatrixCache` or str, optional
+        Cache, or cache directory, to use. Without a cache the matrix is
+        computed every time.
+    restrict_to_cylindrical_FOV : bool, optional
+    settings : dict, optional
+        Symmetries and number of tangential LORs,
+        defaults to `PROJ_MATRIX_SETTINGS`.
+    segments : sequence of int, optional
+        Only keep the rows of these segments, defaults to all segments.
+    subset_num, num_subsets : int, optional
+        Only keep the rows of the views of a subset.
+
+    Returns
+    -------
+    matrix : `scipy.sparse.csr_matrix`
+        With a cache, the full matrix is cached and the rows are selected
+        from it; without, only the selected rows are computed.
+    """
+    def compute(**selection):
+        proj_matrix = make_proj_matrix(
+            proj_data_info, stir_domain,
+            restrict_to_cylindrical_FOV=restrict_to_cylindrical_FOV,
+            settings=settings)
+        return compute_system_matrix(proj_matrix, proj_data_info, stir_domain,
+                                     **selection)
+
+    if cache is None:
+        return compute(segments=segments, subset_num=subset_num,
+                       num_subsets=num_subsets)
+    if not isinstance(cache, SystemMatrixCache):
+        cache = SystemMatrixCache(cache)
+    key = system_matrix_key(compression, stir_domain, proj_data_info,
+                            restrict_to_cylindrical_FOV, settings)
+    matrix = cache.get(key, compute)
+    return select_rows(matrix, proj_data_info, segments, subset_num, num_subsets)
+
+
+class SystemMatrixOperator(Operator):
+
+    """A linear operator applying a precomputed sparse system matrix."""
+
+    def __init__(self, domain, range, matrix, adjoint=None):
+        """Initialize a new instance.
+
+        Parameters
+        ----------
+        domain : `DiscreteLp`
+            Space whose flattened elements the matrix is applied to.
+        range : `DiscreteLp`
+            Space of the flattened results.
+        matrix : `scipy.sparse.spmatrix`
+            Matrix of shape ``(range.size, domain.size)``.
+        adjoint : `SystemMatrixOperator`, optional
+            A pre-initialized adjoint.
+        """
+        if matrix.shape != (range.size, domain.size):
+            raise ValueError('matrix shape {} does not match ({}, {})'
+                             ''.format(matrix.shape, range.size, domain.size))
+        super().__init__(domain, range, linear=True)
+        self.matrix = matrix
+        self._adjoint = adjoint
+        self._row_blocks = {}
+        self.description = None
+
+    def __reduce_ex__(self, protocol):
+        """Pickle the operator as its description when it has one.
+
+        The matrix is then memory-mapped again from the cache when
+        unpickled, instead of being copied into the pickle.
+        """
+        if self.description is not None:
+            return (projector_from_description, (self.description,))
+        adjoint = self._adjoint
+        if adjoint is not None and adjoint.description is not None:
+            return (_adjoint_of, (adjoint,))
+        return super().__reduce_ex__(protocol)
+
+    def _call(self, x, out):
+        """Apply the matrix."""
+        result = self.matrix.dot(np.asarray(x).ravel())
+        out[:] = result.reshape(self.range.shape)
+
+    def apply_batch(self, inputs, out=None, num_threads=1):
+        """
+        Apply the operator to a stack of inputs at once.
+
+        The stack is multiplied as a single matrix of right-hand sides,
+        which is much faster than one product per input.
+
+        Parameters
+        ----------
+        inputs : array-like
+            Array of shape ``(N,) + domain.shape``.
+        out : `numpy.ndarray`, optional
+            Array of shape ``(N,) + range.shape`` to write the results into.
+        num_threads : int, optional
+            Number of threads, each multiplying a block of rows of the
+            matrix. SciPy releases the GIL during sparse products. The
+            blocks are sliced from the matrix on the first call with a
+            given number of threads and kept, which holds a copy of the
+            matrix in memory.
+
+        Returns
+        -------
+        out : `numpy.ndarray`
+        """
+        inputs = np.asarray(inputs, dtype=self.matrix.dtype)
+        if inputs.shape[1:] != self.domain.shape:
+            raise ValueError('inputs shape {} does not match (N,) + {}'
+                             ''.format(inputs.shape, self.domain.shape))
+        num = len(inputs)
+        if out is None:
+            out = np.empty((num,) + self.range.shape, dtype=self.range.dtype)
+        elif out.shape != (num,) + self.range.shape:
+            raise ValueError('out shape {} does not match ({},) + {}'
+                             ''.format(out.shape, num, self.range.shape))
+        # the right-hand sides are the columns of a (domain.size, N) matrix
+        rhs = inputs.reshape(num, -1).T
+        flat_out = out.reshape(num, -1)
+
+        if num_threads == 1:
+            flat_out[:] = self.matrix.dot(rhs).T
+            return out
+
+        def multiply(block):
+            rows, matrix = block
+            flat_out[:, rows] = matrix.dot(rhs).T
+
+        with ThreadPoolExecutor(num_threads) as executor:
+            list(executor.map(multiply, self._get_row_blocks(num_threads)))
+        return out
+
+    def _get_row_blocks(self, num_blocks):
+        """Row slices of the matrix and the matrix blocks they select."""
+        if num_blocks not in self._row_blocks:
+            bounds = np.linspace(0, self.matrix.shape[0], num_blocks + 1).astype(int)
+            rows = [slice(start, stop) for (start, stop) in zip(bounds[:-1], bounds[1:])]
+            self._row_blocks[num_blocks] = [(r, self.matrix[r]) for r in rows]
+        return self._row_blocks[num_blocks]
+
+    @property
+    def adjoint(self):
+        """Operator applying the transposed matrix, converted once to CSR."""
+        if self._adjoint is None:
+            self._adjoint = SystemMatrixOperator(
+                self.range, self.domain, self.matrix.T.tocsr(), adjoint=self)
+        return self._adjoint
+
+
+def _adjoint_of(operator):
+    """Unpickle the adjoint of an operator."""
+    return operator.adjoint
@@ -9,14 +9,19 @@
 This module parses Interfile files.
 """
 
-__all__ = ['FileParser', 'load', 'listmode_to_sinogram']
+__all__ = ['FileParser', 'ProjDataReader', 'load', 'parse_header', 'parse_many',
+           'write_volume', 'write_proj_data', 'listmode_to_sinogram']
 import json
 import os
-# Works with Python 2
-try:
-    from StringIO import StringIO
-except ImportError:  # Python 3
-    from io import StringIO
+import re
+import tempfile
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from . import petlink32
 
 
 class ParsingError(Exception):
@@ -299,6 +304,170 @@ class LineParser:
         return outlist
 
 
+# Single pass parser, giving the same results as LineParser on every line
+_IGNORE_TABLE = str.maketrans(dict.fromkeys(IGNORE))
+_LIST_TABLE = str.maketrans(dict.fromkeys("{}"))
+_UNIT = re.compile(r'([^(]*)\((.*)\)$', re.DOTALL)
+_INT = re.compile(r'[+-]?[0-9]+$')
+_FLOAT = re.compile(r'[+-]?(?:[0-9]+\.?[0-9]*|\.[0-9]+)(?:[eE][+-]?[0-9]+)?$')
+# strings that int() or float() may still accept
+_MAYBE_NUMBER = re.compile(r'[0-9]|nan|inf', re.IGNORECASE)
+
+
+def _convert(s):
+    """Convert a string to int or float if possible, as LineParser does."""
+    if _INT.match(s):
+        return int(s)
+    if _FLOAT.match(s):
+        return float(s)
+    if _MAYBE_NUMBER.search(s):
+        # unusual numbers, e.g. with underscores or surrounding tabs
+        try:
+            return int(s)
+        except ValueError:
+            try:
+                return float(s)
+            except ValueError:
+                pass
+    return s
+
+
+def parse_header_string(header_string):
+    """
+    Parse the content of an Interfile header in a single pass.
+    Args:
+        header_string (str): header string.
+    Returns:
+        dict: Dictionary of parsed Interfile key-value pairs, with the same
+            schema as `FileParser.to_dict`.
+    """
+    result = {}
+    for line_index, line in enumerate(header_string.split('\n'), start=1):
+        if any(t in line for t in TITLES):
+            continue
+        stripped = line.strip(' ')
+        if stripped.startswith(tuple(COMMENT)):
+            continue
+        if line.endswith('\r'):
+            line = line[:-1]
+        segments = line.split(DECLARATION)
+        if len(segments) != 2:
+            if len(segments) > 2:
+                raise ParsingError("Line %s contains too many '%s'. \n %s "
+                                   % (str(line_index), DECLARATION, line))
+            if line.translate(_IGNORE_TABLE).strip(' '):
+                raise ParsingError("Line %s does not contain '%s'. \n %s "
+                                   % (str(line_index), DECLARATION, line))
+            continue
+        left, right = segments
+
+        left = left.strip(' ').translate(_IGNORE_TABLE)
+        is_obligatory = left.lstrip(' ').startswith(tuple(OBLIGATORY))
+        for st in OBLIGATORY:
+            left = left.replace(st, '')
+        unit_measure = None
+        if left.endswith(')'):
+            match = _UNIT.match(left)
+            if match is None:
+                raise ParsingError("The parenthesis in line %s was not opened. \n %s "
+                                   % (str(line_index), line))
+            left, unit_measure = match.group(1), match.group(2).strip(' ')
+
+        right = right.strip(' ')
+        if not right.translate(_IGNORE_TABLE).strip(' '):
+            data = None
+        elif right.lower() == 'none':
+            data = None
+        elif right.startswith('{'):
+            data = [_convert(x) for x in right.translate(_LIST_TABLE).split(',')]
+        else:
+            data = _convert(right)
+
+        result[left.strip(' ')] = {'value': data, 'unit': unit_measure, 'type': None,
+                                   'listindex': None, 'obligatory': is_obligatory}
+    return result
+
+
+# Maximum number of parsed headers kept by `parse_header`
+HEADER_CACHE_SIZE = 4096
+
+# Parsed headers by absolute path, with the modification time and size they
+# were parsed at, least recently used first
+_header_cache = OrderedDict()
+_header_cache_lock = threading.Lock()
+
+
+def parse_header(filename, use_cache=True):
+    """
+    Parse an Interfile header file, reusing the previous result if the
+    file has not changed since (same modification time and size). The
+    last `HEADER_CACHE_SIZE` headers used are kept.
+    Args:
+        filename (str): header file name.
+        use_cache (bool): set to False to always parse the file.
+    Returns:
+        dict: Dictionary of parsed Interfile key-value pairs
+    """
+    path = os.path.abspath(filename)
+    stat = os.stat(path)
+    stamp = (stat.st_mtime_ns, stat.st_size)
+    if use_cache:
+        with _header_cache_lock:
+            cached = _header_cache.get(path)
+            if cached is not None:
+                _header_cache.move_to_end(path)
+        if cached is not None and cached[0] == stamp:
+            return _copy_header(cached[1])
+    with open(path, 'r') as fid:
+        parsed = parse_header_string(fid.read())
+    if use_cache:
+        with _header_cache_lock:
+            _header_cache[path] = (stamp, parsed)
+            _header_cache.move_to_end(path)
+            while len(_header_cache) > HEADER_CACHE_SIZE:
+                _header_cache.popitem(last=False)
+        parsed = _copy_header(parsed)
+    return parsed
+
+
+def _copy_header(parsed):
+    # the entries are copied so that callers cannot modify the cache
+    return {name: dict(entry) for name, entry in parsed.items()}
+
+
+def clear_header_cache():
+    """Forget all the parsed headers."""
+    with _header_cache_lock:
+        _header_cache.clear()
+
+
+def parse_many(filenames, num_threads=None, use_cache=True, return_errors=False):
+    """
+    Parse several Interfile header files, optionally in a thread pool.
+    Args:
+        filenames (list): header file names.
+        num_threads (int): number of threads, defaults to a single thread.
+        use_cache (bool): see `parse_header`.
+        return_errors (bool): return the error of a file that cannot be
+            read or parsed in place of its dictionary, instead of raising it.
+    Returns:
+        list: the parsed dictionaries, in the order of ``filenames``.
+    """
+    def parse(filename):
+        try:
+            return parse_header(filename, use_cache)
+        except (ParsingError, OSError, ValueError) as error:
+            # ValueError includes the UnicodeDecodeError of binary files
+            if not return_errors:
+                raise
+            return error
+
+    if num_threads is None or num_threads == 1:
+        return [parse(f) for f in filenames]
+    with ThreadPoolExecutor(num_threads) as executor:
+        return list(executor.map(parse, filenames))
+
+
 class FileParser:
     """
     Parser for Interfile files.
@@ -325,24 +494,7 @@ class FileParser:
             header_string (str): header string.
         Returns:
             dict: Dictionary of parsed Interfile key-value pairs"""
-
-        self.dict = {}
-        line_parser = LineParser()
-
-        fid = StringIO()
-        fid.write(header_string)
-        fid.seek(0)
-
-        # parse each line 
-        line_index = 0
-        for line in fid:
-            line_index += 1
-            line_dict = line_parser.parse(line, line_index)
-            if line_dict:
-                name = line_dict['name']
-                line_dict.pop('name')
-                self.dict[name] = line_dict
-        fid.close()
+        self.dict = parse_header_string(header_string)
         return self.dict
 
     def parse_file(self, header_filename):
@@ -352,9 +504,8 @@ class FileParser:
         Returns:
             dict: Dictionary of parsed Interfile key-value pairs
         """
-        with open(header_filename, 'r') as fid:
-            file_content = fid.read()
-        return self.parse_string(file_content)
+        self.dict = parse_header(header_filename)
+        return self.dict
 
     def to_dict(self):
         """Get the Interfile key-value pairs as a Python dictionary.
@@ -396,3 +547,548 @@ def load(filename):
     """
     parser = FileParser()
     return parser.parse_file(filename)
+
+
+# NumPy types of the Interfile number formats, by number of bytes per pixel
+NUMBER_FORMATS = {
+    'float': {4: 'f4', 8: 'f8'},
+    'short float': {4: 'f4'},
+    'long float': {8: 'f8'},
+    'signed integer': {1: 'i1', 2: 'i2', 4: 'i4', 8: 'i8'},
+    'unsigned integer': {1: 'u1', 2: 'u2', 4: 'u4', 8: 'u8'},
+}
+BYTE_ORDERS = {'littleendian': '<', 'bigendian': '>'}
+
+
+def _normalize_key(name):
+    return ''.join(name.lower().split())
+
+
+class ProjDataReader(FileParser):
+    """
+    Memory-mapped reader of the projection data of an Interfile .hs header.
+    The data file is never read as a whole: segments and views are read
+    from disk when accessed.
+    Attributes:
+        header (str): name of the Interfile header file.
+        data_file (str): path of the binary data file.
+        dtype (numpy.dtype): type of the values in the file.
+        segments (list): segment numbers, in the order of the file.
+        sinogram_info (list): (segment, number of axial positions), by
+            increasing segment, as returned by `get_sinogram_info`.
+        shape (tuple): (sinograms, views, tangential) shape of the data,
+            as `get_shape_from_proj_data`.
+        view_first (bool): True if each segment is stored by view, then
+            axial position (STIR's Segment_View_AxialPos_TangPos order),
+            False if by axial position, then view.
+        scale (float): image scaling factor of the values.
+    """
+
+    def __init__(self, header):
+        super().__init__(header)
+        self.header = header
+        keys = {_normalize_key(name): entry['value'] for name, entry in self.dict.items()}
+
+        def get(name, default=None):
+            return keys.get(_normalize_key(name), default)
+
+        data_file = get('name of data file')
+        if data_file is None:
+            raise ParsingError("No data file in %s" % header)
+        self.data_file = os.path.join(os.path.dirname(os.path.abspath(header)), str(data_file))
+
+        number_format = str(get('number format', 'float')).lower()
+        num_bytes = get('number of bytes per pixel', 4)
+        byte_order = str(get('imagedata byte order', 'LITTLEENDIAN')).lower()
+        try:
+            self.dtype = np.dtype(BYTE_ORDERS[byte_order] + NUMBER_FORMATS[number_format][num_bytes])
+        except KeyError:
+            raise ParsingError("Unsupported data type: %s, %s bytes, %s"
+                               % (number_format, num_bytes, byte_order))
+        self.offset = int(get('data offset in bytes[1]', 0) or 0)
+        self.scale = float(get('image scaling factor[1]', 1) or 1)
+
+        labels = [str(get('matrix axis label [%d]' % i, '')).lower() for i in (1, 2, 3, 4)]
+        if labels[0] != 'tangential coordinate' or labels[3] != 'segment':
+            raise ParsingError("Unsupported axes %s" % labels)
+        self.view_first = labels[2] == 'view'
+        view_axis, axial_axis = (3, 2) if self.view_first else (2, 3)
+        self.num_views = get('matrix size [%d]' % view_axis)
+        self.num_tangential = get('matrix size [1]')
+        axial_sizes = _as_list(get('matrix size [%d]' % axial_axis))
+        min_differences = _as_list(get('minimum ring difference per segment', [0]))
+        max_differences = _as_list(get('maximum ring difference per segment', [0]))
+
+        # segment 0 holds ring difference 0, the others are numbered by ring difference
+        by_difference = sorted(range(len(min_differences)), key=lambda i: min_differences[i])
+        zero = [i for i in by_difference
+                if min_differences[i] <= 0 <= max_differences[i]][0]
+        self.segments = [by_difference.index(i) - by_difference.index(zero)
+                         for i in range(len(min_differences))]
+        self.axial_sizes = dict(zip(self.segments, axial_sizes))
+        self.sinogram_info = [(segment, self.axial_sizes[segment])
+                              for segment in sorted(self.segments)]
+        self.shape = (sum(axial_sizes), self.num_views, self.num_tangential)
+
+        # element offset of each segment in the file
+        sizes = [size * self.num_views * self.num_tangential for size in axial_sizes]
+        starts = np.concatenate([[0], np.cumsum(sizes)])
+        self._segment_starts = dict(zip(self.segments, starts[:-1].tolist()))
+        self._data = np.memmap(self.data_file, dtype=self.dtype, mode='r',
+                               offset=self.offset, shape=(int(starts[-1]),))
+
+    def get_segment(self, segment):
+        """
+        Memory-mapped view of the sinograms of a segment.
+        Args:
+            segment (int): segment number.
+        Returns:
+            numpy.memmap: (axial positions, views, tangential) view of the
+                file, strided when the file is stored by view.
+        """
+        if segment not in self.axial_sizes:
+            raise ValueError("Segment %s not in %s" % (segment, self.segments))
+        start = self._segment_starts[segment]
+        size = self.axial_sizes[segment]
+        flat = self._data[start:start + size * self.num_views * self.num_tangential]
+        if self.view_first:
+            return flat.reshape(self.num_views, size, self.num_tangential).transpose(1, 0, 2)
+        return flat.reshape(size, self.num_views, self.num_tangential)
+
+    def read(self, segments=None, views=None, out=None):
+        """
+        Read sinograms of some segments and views into memory.
+        Args:
+            segments (list): segments to read, defaults to all of them.
+                They are returned in the order 0, +1, -1, ... of the
+                projection data.
+            views (slice): views to read, defaults to all of them.
+            out (numpy.ndarray): optional array to read into.
+        Returns:
+            numpy.ndarray: float32 array of shape (sinograms, views, tangential),
+                scaled by the image scaling factor.
+        """
+        if segments is None:
+            segments = self.segments
+        segments = sorted(set(segments), key=_segment_order)
+        if views is None:
+            views = slice(None)
+        num_views = len(range(self.num_views)[views])
+        shape = (sum(self.axial_sizes[s] for s in segments), num_views, self.num_tangential)
+        if out is None:
+            out = np.empty(shape, dtype=np.float32)
+        elif out.shape != shape:
+            raise ValueError("out shape %s does not match %s" % (out.shape, shape))
+        row = 0
+        for segment in segments:
+            size = self.axial_sizes[segment]
+            out[row:row + size] = self.get_segment(segment)[:, views]
+            row += size
+        if self.scale != 1:
+            out *= self.scale
+        return out
+
+    @property
+    def memmap(self):
+        """
+        The whole data as a (sinograms, views, tangential) memory map.
+        Only possible when the file stores the segments in the order 0, +1,
+        -1, ... of the projection data, each by axial position then view
+        (as `write_proj_data` does); otherwise use `get_segment` or `read`.
+        """
+        if self.view_first and self.num_views > 1 and max(self.axial_sizes.values()) > 1:
+            raise ValueError("The file is stored by view, use get_segment or read")
+        if self.segments != sorted(self.segments, key=_segment_order):
+            raise ValueError("The segments of the file are in the order %s, "
+                             "use get_segment or read" % self.segments)
+        return self._data.reshape(self.shape)
+
+
+# Number of bytes converted and written at a time by the writers
+WRITE_CHUNK_SIZE = 2**24
+
+
+def _data_chunks(data, chunk_rows=None):
+    """
+    Iterate over chunks of an array, ODL element or iterable of arrays,
+    along the first axis.
+    """
+    if not isinstance(data, np.ndarray) and hasattr(data, 'asarray'):
+        data = data.asarray()
+    if isinstance(data, np.ndarray):
+        if chunk_rows is None:
+            row_bytes = max(data[0].size * 4, 1) if len(data) else 1
+            chunk_rows = max(WRITE_CHUNK_SIZE // row_bytes, 1)
+        for start in range(0, len(data), chunk_rows):
+            yield data[start:start + chunk_rows]
+    else:
+        for chunk in data:
+            yield chunk
+
+
+def _write_data(data_path, data, row_shape, num_rows):
+    """
+    Stream data to a little endian float32 file, checking its shape.
+    """
+    written = 0
+    with open(data_path, 'wb') as fid:
+        for chunk in _data_chunks(data):
+            chunk = np.asarray(chunk)
+            if chunk.ndim == len(row_shape):
+                chunk = chunk[None]
+            if chunk.shape[1:] != tuple(row_shape):
+                raise ValueError("Chunk of shape %s does not match (n,) + %s"
+                                 % (chunk.shape, tuple(row_shape)))
+            chunk.astype('<f4', copy=False).tofile(fid)
+            written += len(chunk)
+    if written != num_rows:
+        raise ValueError("Wrote %s rows of %s, expected %s"
+                         % (written, tuple(row_shape), num_rows))
+
+
+def _write_header(header, lines):
+    with open(header, 'w') as fid:
+        fid.write('\n'.join(['!INTERFILE  :='] + lines + ['!END OF INTERFILE :=', '']))
+
+
+def _data_path(header, extension):
+    return os.path.splitext(header)[0] + extension
+
+
+def write_volume(header, data, space):
+    """
+    Write a volume as an Interfile .hv header and a float32 .v data file.
+    The data are streamed to the file in chunks, so a memory map or an
+    iterator over slices does not need to fit in memory.
+    Args:
+        header (str): name of the header file. The data file has the same
+            name with the extension .v.
+        data: ODL element, array or memory map of shape space.shape, or
+            iterable of (z, y, x) slabs or (y, x) slices, along z.
+        space: (z, y, x) ODL space of the volume, as given by
+            `space_from_stir_domain`.
+    """
+    data_path = _data_path(header, '.v')
+    _write_data(data_path, data, space.shape[1:], space.shape[0])
+    sizes = space.cell_sides
+    # STIR gives the position of the centre of the first voxel
+    first = np.asarray(space.min_pt) + sizes / 2
+    lines = ['name of data file := %s' % os.path.basename(data_path),
+             '!GENERAL DATA :=',
+             '!GENERAL IMAGE DATA :=',
+             '!type of data := PET',
+             'imagedata byte order := LITTLEENDIAN',
+             '!PET STUDY (General) :=',
+             '!PET data type := Image',
+             'process status := Reconstructed',
+             '!number format := float',
+             '!number of bytes per pixel := 4',
+             'number of dimensions := 3']
+    # Interfile axis 1 is x, the fastest varying
+    for axis, (label, index) in enumerate(zip('xyz', (2, 1, 0)), start=1):
+        lines += ['matrix axis label [%d] := %s' % (axis, label),
+                  '!matrix size [%d] := %d' % (axis, space.shape[index]),
+                  'scaling factor (mm/pixel) [%d] := %s' % (axis, _format_float(sizes[index]))]
+    for axis, index in zip((1, 2, 3), (2, 1, 0)):
+        lines.append('first pixel offset (mm) [%d] := %s' % (axis, _format_float(first[index])))
+    lines.append('number of time frames := 1')
+    _write_header(header, lines)
+
+
+def _format_float(value):
+    return '%.9g' % float(value)
+
+
+def _ring_differences(segment, span, max_diff_ring):
+    """Minimum and maximum ring difference of a segment of a CTI geometry."""
+    if span == 1:
+        low = high = abs(segment)
+    else:
+        low = max(abs(segment)*span - (span - 1)//2, 0)
+        high = min(abs(segment)*span + (span - 1)//2, max_diff_ring)
+    if segment < 0:
+        return -high, -low
+    if segment == 0:
+        return -high, high
+    return low, high
+
+
+def _scanner_lines(scanner):
+    """Scanner parameters of a `Scanner`, as written by STIR."""
+    return ['Scanner parameters:=',
+            'Scanner type := Userdefined',
+            'Number of rings := %d' % scanner.num_rings,
+            'Number of detectors per ring := %d' % scanner.num_dets_per_ring,
+            'Inner ring diameter (cm) := %s' % _format_float(2 * scanner.det_radius / 10),
+            'Average depth of interaction (cm) := %s' % _format_float(scanner.average_depth_of_inter / 10),
+            'Distance between rings (cm) := %s' % _format_float(scanner.ring_spacing / 10),
+            'Default bin size (cm) := %s' % _format_float(scanner.voxel_size_xy / 10),
+            'View offset (degrees) := %s' % _format_float(np.degrees(scanner.intrinsic_tilt)),
+            'Maximum number of non-arc-corrected bins := %d' % scanner.max_num_non_arc_cor_bins,
+            'Default number of arc-corrected bins := %d' % scanner.default_non_arc_cor_bins,
+            'Number of blocks per bucket in transaxial direction := %d' % scanner.trans_blocks_per_bucket,
+            'Number of blocks per bucket in axial direction := %d' % scanner.axials_blocks_per_bucket,
+            'Number of crystals per block in axial direction := %d' % scanner.axial_crystals_per_block,
+            'Number of crystals per block in transaxial direction := %d' % scanner.trans_crystals_per_block,
+            'Number of detector layers := %d' % scanner.num_detector_layers,
+            'Number of crystals per singles unit in axial direction := %d'
+            % scanner.axial_crystals_per_singles_unit,
+            'Number of crystals per singles unit in transaxial direction := %d'
+            % scanner.trans_crystals_per_singles_unit,
+            'end scanner parameters:=']
+
+
+def write_proj_data(header, data, compression):
+    """
+    Write projection data as an Interfile .hs header and a float32 .s
+    data file. The data are streamed to the file in chunks, so a memory
+    map or an iterator over sinograms does not need to fit in memory.
+    The file stores the segments in the order 0, +1, -1, ... of the
+    projection data, each by axial position then view, so that
+    `ProjDataReader.memmap` maps it back without copy.
+    Args:
+        header (str): name of the header file. The data file has the same
+            name with the extension .s.
+        data: ODL element, array or memory map of shape (sinograms, views,
+            tangential), or iterable of (sinograms, views, tangential)
+            chunks or (views, tangential) sinograms.
+        compression (Compression): geometry of the data.
+    """
+    info = compression._get_sinogram_info()
+    stir_info = compression.get_stir_proj_data_info()
+    num_views = stir_info.get_num_views()
+    num_tangential = stir_info.get_num_tangential_poss()
+    data_path = _data_path(header, '.s')
+    _write_data(data_path, data, (num_views, num_tangential), sum(size for (_, size) in info))
+
+    sizes = dict(info)
+    segments = sorted(sizes, key=_segment_order)
+    differences = [_ring_differences(segment, compression.span_num, compression.max_diff_ring)
+                   for segment in segments]
+    corrections = '{arc correction}' if compression.data_arc_corrected else '{None}'
+    lines = ['name of data file := %s' % os.path.basename(data_path),
+             'originating system := Userdefined',
+             '!GENERAL DATA :=',
+             '!GENERAL IMAGE DATA :=',
+             '!type of data := PET',
+             'imagedata byte order := LITTLEENDIAN',
+             '!PET STUDY (General) :=',
+             '!PET data type := Emission',
+             'applied corrections := %s' % corrections,
+             '!number format := float',
+             '!number of bytes per pixel := 4',
+             'number of dimensions := 4',
+             'matrix axis label [4] := segment',
+             '!matrix size [4] := %d' % len(segments),
+             'matrix axis label [3] := axial coordinate',
+             '!matrix size [3] := { %s}' % ','.join(str(sizes[s]) for s in segments),
+             'matrix axis label [2] := view',
+             '!matrix size [2] := %d' % num_views,
+             'matrix axis label [1] := tangential coordinate',
+             '!matrix size [1] := %d' % num_tangential,
+             'minimum ring difference per segment := { %s}' % ','.join(str(d[0]) for d in differences),
+             'maximum ring difference per segment := { %s}' % ','.join(str(d[1]) for d in differences)]
+    lines += _scanner_lines(compression.scanner)
+    lines += ['image scaling factor[1] := 1',
+              'data offset in bytes[1] := 0',
+              'number of time frames := 1']
+    _write_header(header, lines)
+
+
+def _as_list(value):
+    return value if isinstance(value, list) else [value]
+
+
+def _segment_order(segment):
+    """Position of a segment in the order 0, +1, -1, +2, ..."""
+    return 2*segment - 1 if segment > 0 else -2*segment
+
+
+LISTMODE_CHUNK_SIZE = 2**23
+
+
+def _siemens_segment_order(segment):
+    """Position of a segment in the order 0, -1, +1, -2, ... of Siemens listmode bins"""
+    return 2*segment if segment > 0 else -2*segment - 1 if segment < 0 else 0
+
+
+def _listmode_rows(compression, segment_sequence=None):
+    """Compression sinogram row of each sinogram of the listmode bin addresses."""
+    sizes = dict(compression.get_geometry().sinogram_info)
+    if segment_sequence is None:
+        segment_sequence = sorted(sizes, key=_siemens_segment_order)
+    segments = np.concatenate([np.full(sizes[s], s) for s in segment_sequence])
+    axials = np.concatenate([np.arange(sizes[s]) for s in segment_sequence])
+    return compression.get_rows(segments, axials)
+
+
+# the bins are counted by blocks of 2**COUNT_BLOCK_BITS
+COUNT_BLOCK_BITS = 22
+
+
+def _count_bins(counts, index):
+    """
+    Add the counts of bin indices to a flat array with np.bincount. The
+    indices are first grouped by block of bins, with a linear time (radix)
+    stable sort of their block numbers, so that each bincount only spans
+    one block instead of all the bins. Integer counts that would exceed
+    the maximum of their type raise an OverflowError instead of wrapping.
+    """
+    if not len(index):
+        return
+    low = int(index.min())
+    offsets = index - low
+    span = int(offsets.max()) + 1
+    bits = max(COUNT_BLOCK_BITS, span.bit_length() - 16)
+    blocks = (offsets >> bits).astype(np.uint16)
+    offsets = offsets[np.argsort(blocks, kind='stable')]
+    start = 0
+    for block, end in enumerate(np.cumsum(np.bincount(blocks))):
+        if end > start:
+            block_low = block << bits
+            block_counts = np.bincount(offsets[start:end] - block_low)
+            target = counts[low + block_low:low + block_low + len(block_counts)]
+            if np.issubdtype(counts.dtype, np.integer):
+                total = target.astype(np.int64) + block_counts
+                if total.max() > np.iinfo(counts.dtype).max:
+                    raise OverflowError('Bin counts exceed the maximum of {}, use a wider '
+                                        'dtype'.format(counts.dtype))
+                target[:] = total
+            else:
+                np.add(target, block_counts, out=target, casting='unsafe')
+        start = end
+
+
+_FRAME = re.compile(r'^(?:([0-9]+)\s*[x*]\s*)?([0-9.]+)\s*s?$')
+
+
+def _parse_framing(frames):
+    """
+    Frame (start, end) times in ms, from a list of them or from a framing
+    protocol string of consecutive frames, e.g. '6x10s, 3x60s, 5x300s' or
+    '6*10, 3*60, 5*300' (number of frames times their duration in s).
+    """
+    if isinstance(frames, str):
+        bounds = [0]
+        for part in frames.split(','):
+            match = _FRAME.match(part.strip())
+            if match is None:
+                raise ValueError("Invalid framing protocol: %r" % frames)
+            number = int(match.group(1) or 1)
+            duration = int(round(float(match.group(2)) * 1000))
+            bounds += [bounds[-1] + duration*(k+1) for k in range(number)]
+        frames = list(zip(bounds[:-1], bounds[1:]))
+    frames = np.asarray(frames, dtype=np.int64).reshape(-1, 2)
+    if np.any(frames[:, 1] <= frames[:, 0]) or np.any(frames[1:, 0] < frames[:-1, 1]):
+        raise ValueError("Frames must be increasing and not overlap: %s" % frames.tolist())
+    return frames
+
+
+def listmode_to_sinogram(listmode, compression, dtype=np.float32,
+                         chunk_size=LISTMODE_CHUNK_SIZE, segment_sequence=None,
+                         frames=None, out=None):
+    """
+    Histogram PETLink 32-bit listmode data into prompt and delayed sinograms.
+    The listmode words are read through a memory map ``chunk_size`` words
+    at a time and the bins of their events are added to the sinograms with
+    `np.bincount`, block of bins by block, so besides the sinograms memory
+    use only depends on the chunk size, not on the sinogram or file sizes.
+    The bin address of an event is ``(sinogram*views + view)*tangential +
+    tangential position``, with the sinograms of the segments stored in
+    ``segment_sequence`` order, each by axial position. Bin addresses past
+    the sinograms (time of flight bins) are summed into them.
+    With ``frames``, the file is still read once: the events are routed to
+    the frame of the last elapsed time marker before them, and each frame
+    is written to the output memory maps when the time passes its end, so
+    only one frame is kept in memory. Events outside the frames are skipped.
+    Args:
+        listmode (str or array): listmode data file (e.g. .l), or its words.
+        compression (Compression): geometry of the listmode bins, and of
+            the sinograms.
+        dtype: type of the sinograms, e.g. np.float32 or np.uint16. An
+            OverflowError is raised if a bin gets more counts than an integer
+            type holds (65535 for np.uint16); float32 counts are exact up to
+            2**24.
+        chunk_size (int): number of words histogrammed at once.
+        segment_sequence (list): segments in the order of the bin
+            addresses. Defaults to the Siemens order 0, -1, +1, -2, ...
+        frames (list or str): (start, end) times in ms of the frames, or a
+            framing protocol such as '6x10s, 3x60s, 5x300s'.
+        out (tuple): file names of the prompt and delayed memory maps of
+            the frames. Defaults to temporary files.
+    Returns:
+        tuple: (prompts, delayeds) arrays of shape (sinograms, views,
+            tangential), or memory maps of shape (frames, sinograms, views,
+            tangential) with ``frames``.
+    """
+    words = petlink32.read_words(listmode) if isinstance(listmode, str) else np.asarray(listmode)
+    rows = _listmode_rows(compression, segment_sequence)
+    shape = (len(rows), compression.num_of_views, compression.get_num_tangential())
+    sinogram_size = shape[1] * shape[2]
+    num_bins = len(rows) * sinogram_size
+    index_dtype = np.int32 if num_bins < 2**31 else np.int64
+    rows = rows.astype(index_dtype)
+    # prompts and delayeds
+    counts = np.zeros((2, num_bins), dtype=dtype)
+
+    def count(index, prompts):
+        _count_bins(counts[0], index[prompts])
+        _count_bins(counts[1], index[~prompts])
+
+    if frames is not None:
+        frames = _parse_framing(frames)
+        if out is None:
+            out = (tempfile.TemporaryFile(), tempfile.TemporaryFile())
+        outputs = [np.memmap(name, dtype=dtype, mode='w+', shape=(len(frames),) + shape)
+                   for name in out]
+    frame = 0
+
+    def close_frame():
+        # write out the current frame, and start the next one
+        nonlocal frame
+        for output, frame_counts in zip(outputs, counts):
+            output[frame] = frame_counts.reshape(shape)
+        counts[:] = 0
+        frame += 1
+
+    time = 0
+    for start in range(0, len(words), chunk_size):
+        chunk = words[start:start + chunk_size]
+        petlink32.release_words(words, start - chunk_size, start)
+        is_event = petlink32.EVENT.compare(chunk)
+        events = chunk[is_event]
+        bins = petlink32.BIN_ADDRESS.evaluate(events).astype(index_dtype)
+        np.remainder(bins, num_bins, out=bins)
+        sinograms, positions = np.divmod(bins, sinogram_size)
+        index = rows[sinograms]
+        index *= sinogram_size
+        index += positions
+        del bins, sinograms, positions
+        prompts = petlink32.PROMPT.compare(events)
+        if frames is None:
+            count(index, prompts)
+            continue
+
+        time_at, time = petlink32.get_time_lookup(chunk, time)
+        times = time_at(np.flatnonzero(is_event))
+        # the times only increase, so the events of a frame are contiguous
+        event_frames = np.searchsorted(frames[:, 0], times, side='right') - 1
+        bounds = np.searchsorted(event_frames, np.arange(frame, len(frames) + 1))
+        for f, begin, end in zip(range(frame, len(frames)), bounds[:-1], bounds[1:]):
+            if begin == end:
+                continue
+            while frame < f:
+                close_frame()
+            # skip the events after the end of the frame, before the next one
+            inside = times[begin:end] < frames[f, 1]
+            count(index[begin:end][inside], prompts[begin:end][inside])
+        while frame < len(frames) and frames[frame, 1] <= time:
+            close_frame()
+
+    if frames is None:
+        return counts[0].reshape(shape), counts[1].reshape(shape)
+    while frame < len(frames):
+        close_frame()
+    for output in outputs:
+        output.flush()
+    return tuple(outputs)
@@ -1,3 +1,9 @@
+import mmap
+from collections import namedtuple
+
+import numpy as np
+
+
 class packet:
     def __init__(self, id_part, value_parts, name="packet part"):
         self.id_part = id_part
@@ -34,7 +40,11 @@ class packet_part:
         return (self.mask & number) >> self.lowbit
 
     def compare(self, number):
-        return self.evaluate(number) == self.value
+        # same as evaluate(number) == value, without the shift.
+        # works elementwise on numpy uint32 arrays too
+        if self.value is None:
+            raise ValueError("{} has no value to compare with".format(self.name))
+        return (self.mask & number) == (self.value << self.lowbit)
 
     def __repr__(self):
         names = [self.name]
@@ -117,3 +127,99 @@ BASIC_GATING_E0_C = packet_part(7)
 
 #   skip 3.2.4 page 12
 
+
+
+#   Vectorized decoding of whole chunks of listmode words.
+#   The packet parts above work elementwise on numpy uint32 arrays, so a chunk
+#   is classified with one mask and compare per packet type, and every packet
+#   gets the time of the last elapsed time marker before it.
+
+WORD_DTYPE = np.dtype('<u4')
+
+PETLinkChunk = namedtuple('PETLinkChunk', [
+    'bins',                 # bin address of each event
+    'prompts',              # True for prompts, False for delayeds
+    'event_times',          # time in ms of each event
+    'dead_time',            # (times, blocks, singles rates)
+    'horizontal_bed',       # (times, positions, is moving)
+    'vertical_bed',         # (times, positions)
+    'gating',               # (times, gating words G)
+    'end_time',             # time of the last time marker, to start the next chunk
+])
+
+
+def read_words(filename):
+    """ memory map of the 32-bit little-endian words of a PETLink listmode file """
+    return np.memmap(filename, dtype=WORD_DTYPE, mode='r')
+
+
+def release_words(words, start, stop):
+    """
+    let the kernel drop the pages of words start to stop of a memory map of read_words
+    once they have been read, so that a whole file does not add up in the resident memory.
+    the pages are only dropped from this process (the file is mapped read only)
+    """
+    file_map = getattr(words, '_mmap', None)
+    if file_map is None or not hasattr(mmap, 'MADV_DONTNEED'):
+        return
+    begin = max(start, 0) * words.itemsize // mmap.PAGESIZE * mmap.PAGESIZE
+    end = min(stop * words.itemsize, len(file_map)) // mmap.PAGESIZE * mmap.PAGESIZE
+    if end > begin:
+        file_map.madvise(mmap.MADV_DONTNEED, begin, end - begin)
+
+
+def get_time_lookup(words, start_time=0):
+    """
+    function giving the time in ms at positions of words,
+    from the last elapsed time marker at or before them (start_time before the first one)
+    """
+    is_time = ELAPSED_TIME_MARKER.compare(words)
+    marker_times = TIME_MS.evaluate(words[is_time])
+    times = np.empty(len(marker_times) + 1, dtype=np.int64)
+    times[0] = start_time
+    times[1:] = marker_times
+    num_markers = np.cumsum(is_time)
+    def lookup(positions):
+        return times[num_markers[positions]]
+    return lookup, int(times[-1])
+
+
+def decode(words, start_time=0):
+    """
+    decode a chunk of listmode words (e.g. a slice of read_words) into columnar arrays.
+    start_time is the time of the previous chunk (its end_time), in ms.
+    """
+    words = np.asarray(words, dtype=WORD_DTYPE)
+    time_at, end_time = get_time_lookup(words, start_time)
+
+    events = np.flatnonzero(EVENT.compare(words))
+    event_words = words[events]
+    bins = BIN_ADDRESS.evaluate(event_words)
+    prompts = PROMPT.compare(event_words)
+
+    def tags(part):
+        positions = np.flatnonzero(part.compare(words))
+        return time_at(positions), words[positions]
+
+    times, tag_words = tags(DEAD_TIME_MARKER)
+    dead_time = (times, DEAD_TIME_BLOCK.evaluate(tag_words), DEAD_TIME_SINGLES_RATE.evaluate(tag_words))
+    times, tag_words = tags(IS_HORIZONTAL_BED)
+    horizontal_bed = (times, HORIZONTAL_BED_POSITION.evaluate(tag_words), IS_HORIZONTAL_MOVING.compare(tag_words))
+    times, tag_words = tags(IS_VERTICAL_BED)
+    vertical_bed = (times, VERTICAL_BED_POSITION.evaluate(tag_words))
+    times, tag_words = tags(BASIC_GATING)
+    gating = (times, BASIC_GATING_E0_G.evaluate(tag_words))
+
+    return PETLinkChunk(bins, prompts, time_at(events), dead_time,
+                        horizontal_bed, vertical_bed, gating, end_time)
+
+
+def iter_decode(words, chunk_size=2**24):
+    """ decode words (an array or a listmode file name) chunk by chunk, keeping the time across chunks """
+    if isinstance(words, str):
+        words = read_words(words)
+    time = 0
+    for start in range(0, len(words), chunk_size):
+        chunk = decode(words[start:start + chunk_size], time)
+        time = chunk.end_time
+        yield chunk
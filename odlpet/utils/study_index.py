@@ -0,0 +1,230 @@
+"""
+Catalogue of the Interfile headers of a directory tree, in SQLite.
+
+`StudyIndex.update` walks a directory, parses the headers that are new or
+changed since the previous run (see `interfile.parse_many`) and stores a
+few key fields of each one, so that studies can be found with a query
+instead of opening every header again. Headers that cannot be parsed are
+listed by `StudyIndex.errors`.
+"""
+
+import json
+import os
+import re
+import sqlite3
+import warnings
+
+from .interfile import parse_many
+
+
+# File name endings of the indexed headers
+HEADER_SUFFIXES = ('.hv', '.hs', '.l.hdr', '.s.hdr', '.v.hdr')
+
+_UNIT = re.compile(r'\([^)]*\)')
+
+_COLUMNS = [
+    ('path', 'TEXT PRIMARY KEY'),
+    ('mtime_ns', 'INTEGER'),
+    ('kind', 'TEXT'),
+    ('scanner', 'TEXT'),
+    ('data_type', 'TEXT'),
+    ('matrix_size', 'TEXT'),
+    ('num_frames', 'INTEGER'),
+    ('start_time', 'REAL'),
+    ('duration', 'REAL'),
+    ('data_file', 'TEXT'),
+    ('data_bytes', 'INTEGER'),
+]
+
+
+def _header_kind(filename):
+    for suffix in HEADER_SUFFIXES:
+        if filename.lower().endswith(suffix):
+            return suffix
+    return None
+
+
+def header_fields(path, header):
+    """
+    Key fields of a parsed Interfile header.
+    Args:
+        path (str): path of the header file.
+        header (dict): parsed header, see `interfile.parse_header`.
+    Returns:
+        dict: the values of the index columns.
+    """
+    values = {}
+    for name, entry in header.items():
+        # units left in the key, e.g. 'image duration (sec)[1]', are dropped
+        values[' '.join(_UNIT.sub(' ', name).lower().split())] = entry['value']
+
+    def first(*names):
+        # per-frame keys are indexed, e.g. 'image duration [1]' for frame 1
+        for name in names:
+            for key in (name, name + ' [1]'):
+                if values.get(key) is not None:
+                    return values[key]
+        return None
+
+    matrix_size = []
+    axis = 1
+    while 'matrix size [%d]' % axis in values:
+        matrix_size.append(values['matrix size [%d]' % axis])
+        axis += 1
+
+    data_file = first('name of data file')
+    data_bytes = None
+    if data_file is not None:
+        data_file = os.path.join(os.path.dirname(path), str(data_file))
+        try:
+            data_bytes = os.path.getsize(data_file)
+        except OSError:
+            pass
+
+    return {
+        'path': path,
+        'kind': _header_kind(path),
+        'scanner': first('originating system', 'scanner type'),
+        'data_type': first('pet data type', 'type of data'),
+        'matrix_size': json.dumps(matrix_size),
+        'num_frames': first('number of time frames'),
+        'start_time': first('image relative start time', 'study time'),
+        'duration': first('image duration'),
+        'data_file': data_file,
+        'data_bytes': data_bytes,
+    }
+
+
+class StudyIndex:
+    """
+    SQLite index of Interfile headers.
+    Attributes:
+        filename (str): the SQLite database file, created if needed.
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.connection = sqlite3.connect(filename)
+        self.connection.row_factory = sqlite3.Row
+        with self.connection:
+            self.connection.execute(
+                'CREATE TABLE IF NOT EXISTS headers ({})'.format(
+                    ', '.join('{} {}'.format(name, kind) for (name, kind) in _COLUMNS)))
+            self.connection.execute(
+                'CREATE TABLE IF NOT EXISTS errors '
+                '(path TEXT PRIMARY KEY, mtime_ns INTEGER, error TEXT)')
+            for column in ('scanner', 'kind', 'data_bytes'):
+                self.connection.execute(
+                    'CREATE INDEX IF NOT EXISTS headers_{0} ON headers ({0})'.format(column))
+
+    def close(self):
+        self.connection.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def update(self, root, num_threads=None):
+        """
+        Index the headers under a directory. Only the headers that are new
+        or were modified since the last update are parsed, and the headers
+        that no longer exist are removed from the index. A header that
+        cannot be parsed is skipped with a warning and recorded in the
+        errors, see `errors`.
+        Args:
+            root (str): directory to walk.
+            num_threads (int): number of threads parsing the headers.
+        Returns:
+            int: number of headers parsed.
+        """
+        root = os.path.abspath(root)
+        found = {}
+        for directory, _, filenames in os.walk(root):
+            for filename in filenames:
+                if _header_kind(filename) is not None:
+                    path = os.path.join(directory, filename)
+                    try:
+                        found[path] = os.stat(path).st_mtime_ns
+                    except OSError:
+                        continue
+
+        known = {}
+        for table in ('headers', 'errors'):
+            known.update(self.connection.execute(
+                "SELECT path, mtime_ns FROM {} WHERE path LIKE ? ESCAPE '\\'".format(table),
+                (_escape_like(os.path.join(root, '')) + '%',)).fetchall())
+        changed = [path for (path, mtime) in found.items() if known.get(path) != mtime]
+        removed = [path for path in known if path not in found]
+
+        headers = parse_many(changed, num_threads=num_threads, use_cache=False,
+                             return_errors=True)
+        rows, errors = [], []
+        for path, header in zip(changed, headers):
+            if isinstance(header, Exception):
+                warnings.warn('Skipping {}: {}'.format(path, header))
+                errors.append((path, found[path], '{}: {}'.format(type(header).__name__, header)))
+                continue
+            fields = header_fields(path, header)
+            fields['mtime_ns'] = found[path]
+            rows.append(tuple(fields[name] for (name, _) in _COLUMNS))
+        with self.connection:
+            for table in ('headers', 'errors'):
+                self.connection.executemany('DELETE FROM {} WHERE path = ?'.format(table),
+                                            [(path,) for path in removed + changed])
+            self.connection.executemany(
+                'INSERT INTO headers VALUES ({})'.format(
+                    ', '.join('?' * len(_COLUMNS))), rows)
+            self.connection.executemany('INSERT INTO errors VALUES (?, ?, ?)', errors)
+        return len(changed)
+
+    def errors(self):
+        """
+        The headers that could not be parsed, as (path, error message) pairs.
+        They are parsed again when they are modified.
+        """
+        return [tuple(row) for row in self.connection.execute(
+            'SELECT path, error FROM errors ORDER BY path')]
+
+    def query(self, where='1', parameters=()):
+        """
+        Indexed headers matching an SQL condition.
+        Args:
+            where (str): condition on the columns of the index, for instance
+                ``"scanner LIKE '%mCT%' AND data_bytes > 1e9"``.
+            parameters (tuple): values of the ``?`` placeholders of ``where``.
+        Returns:
+            list: one dict of column values per header, with the matrix
+                size as a list.
+        """
+        rows = self.connection.execute(
+            'SELECT * FROM headers WHERE {} ORDER BY path'.format(where), parameters)
+        results = []
+        for row in rows:
+            result = dict(row)
+            result['matrix_size'] = json.loads(result['matrix_size'])
+            results.append(result)
+        return results
+
+    def find(self, scanner=None, kind=None, min_bytes=None):
+        """
+        Indexed headers of a scanner (matched as a substring, ignoring case),
+        a kind of header (e.g. '.l.hdr' for listmode) and a minimum data
+        size in bytes.
+        """
+        conditions, parameters = [], []
+        if scanner is not None:
+            conditions.append("scanner LIKE ? ESCAPE '\\'")
+            parameters.append('%' + _escape_like(scanner) + '%')
+        if kind is not None:
+            conditions.append('kind = ?')
+            parameters.append(kind)
+        if min_bytes is not None:
+            conditions.append('data_bytes >= ?')
+            parameters.append(min_bytes)
+        return self.query(' AND '.join(conditions) or '1', tuple(parameters))
+
+
+def _escape_like(s):
+    return s.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
@@ -0,0 +1,182 @@
+from pathlib import Path
+
+import pytest
+import numpy as np
+import stir, stirextra
+
+from odlpet.utils.interfile import ProjDataReader
+
+base = Path(__file__).parent.parent / 'examples' / 'data' / 'stir'
+
+
+def test_read_proj_data():
+    header = (base / 'my_prompts_g1.hs').as_posix()
+    reader = ProjDataReader(header)
+    expected = stirextra.to_numpy(stir.ProjData.read_from_file(header))
+    assert reader.shape == expected.shape
+    np.testing.assert_array_equal(reader.read(), expected)
+    np.testing.assert_array_equal(reader.read(views=slice(3, 9)), expected[:, 3:9])
+    segment = reader.get_segment(0)
+    assert isinstance(segment, np.memmap)
+    np.testing.assert_array_equal(segment, expected)
+
+def test_segment_numbers(tmp_path):
+    header = (Path(__file__).parent / 'data' / 'small.hs').read_text()
+    header = header.replace('originating system', 'name of data file := small.s\noriginating system', 1)
+    (tmp_path / 'small.hs').write_text(header)
+    np.arange(37*28*56, dtype='<f4').tofile((tmp_path / 'small.s').as_posix())
+    reader = ProjDataReader((tmp_path / 'small.hs').as_posix())
+    assert reader.sinogram_info == [(-1, 11), (0, 15), (1, 11)]
+    assert reader.shape == (37, 28, 56)
+    # segments are stored -1, 0, 1, each by view
+    assert reader.get_segment(1)[0, 0, 0] == (11 + 15) * 28 * 56
+    assert reader.get_segment(1)[0, 1, 0] == (11 + 15) * 28 * 56 + 11 * 56
+    data = reader.read(segments=[0, 1])
+    assert data.shape == (26, 28, 56)
+    np.testing.assert_array_equal(data[15:], reader.get_segment(1))
+    with pytest.raises(ValueError):
+        reader.memmap
+
+def test_write_proj_data(tmp_path):
+    from odlpet.scanner.scanner import mCT
+    from odlpet.scanner.compression import Compression
+    from odlpet.utils.interfile import write_proj_data
+    c = Compression(mCT())
+    c.span_num = 3
+    c.max_diff_ring = 4
+    proj = c.get_projector(stir_domain=c.get_stir_domain(zoom=.2))
+    data = proj(proj.domain.one()).asarray()
+    header = (tmp_path / 'data.hs').as_posix()
+    # stream sinogram by sinogram
+    write_proj_data(header, iter(data), c)
+    np.testing.assert_array_equal(ProjDataReader(header).memmap, data)
+    stir_data = stir.ProjData.read_from_file(header)
+    np.testing.assert_array_equal(stirextra.to_numpy(stir_data), data)
+
+def test_write_volume(tmp_path):
+    from odlpet.stir.io import volume_from_file
+    from odlpet.utils.interfile import write_volume
+    volume = volume_from_file((base / 'initial.hv').as_posix())
+    header = (tmp_path / 'volume.hv').as_posix()
+    write_volume(header, volume, volume.space)
+    written = volume_from_file(header)
+    assert written.space.shape == volume.space.shape
+    np.testing.assert_allclose(written.space.min_pt, volume.space.min_pt, atol=1e-3)
+    np.testing.assert_array_equal(written.asarray(), volume.asarray())
+
+def parse_by_line(header_string):
+    from odlpet.utils.interfile import LineParser
+    result = {}
+    parser = LineParser()
+    for index, line in enumerate(header_string.splitlines(True), start=1):
+        parsed = parser.parse(line, index)
+        if parsed:
+            result[parsed.pop('name')] = parsed
+    return result
+
+def test_single_pass_parser():
+    from odlpet.utils.interfile import parse_header_string
+    headers = [p.read_text() for p in base.glob('*.h[sv]')]
+    headers.append("!INTERFILE :=\n%ignored := x\n; comment\n  !key (mm) := 1e3\n"
+                   "list := {1, 2.5, a b}\nnothing := none\nempty :=\n"
+                   "signed := -.5\ntabs := \t4\t\nlast (x [1]) := {}\r\n\n")
+    for header in headers:
+        assert parse_header_string(header) == parse_by_line(header)
+
+def test_header_cache(tmp_path, monkeypatch):
+    import os
+    from odlpet.utils import interfile
+    from odlpet.utils.interfile import parse_header, parse_many, _header_cache
+    path = tmp_path / 'a.hv'
+    path.write_text((base / 'initial.hv').read_text())
+    first = parse_header(str(path))
+    first['matrix size [1]']['value'] = None
+    assert parse_header(str(path))['matrix size [1]']['value'] == 64
+    path.write_text((base / 'FDG_g1.hv').read_text())
+    os.utime(str(path), ns=(0, 10**9))
+    assert parse_header(str(path))['matrix size [1]']['value'] == 155
+    results = parse_many([str(path)] * 4 + [str(base / 'initial.hv')], num_threads=2)
+    assert [r['matrix size [1]']['value'] for r in results] == [155] * 4 + [64]
+    # only the most recently used headers are kept
+    monkeypatch.setattr(interfile, 'HEADER_CACHE_SIZE', 1)
+    other = tmp_path / 'b.hv'
+    other.write_text(path.read_text())
+    parse_header(str(other))
+    assert list(_header_cache) == [os.path.abspath(str(other))]
+
+def listmode_compression():
+    from odlpet.scanner.scanner import mCT
+    from odlpet.scanner.compression import Compression
+    c = Compression(mCT())
+    c.span_num = 3
+    c.max_diff_ring = 4
+    c.num_of_views = 24
+    return c
+
+def test_listmode_to_sinogram(tmp_path):
+    from odlpet.utils.interfile import listmode_to_sinogram
+    from odlpet.utils import petlink32
+    c = listmode_compression()
+    num_views, num_tangential = c.num_of_views, c.get_num_tangential()
+    # bins of the sinograms in the Siemens segment order 0, -1, +1
+    sizes = dict(c._get_sinogram_info())
+    segments = np.concatenate([np.full(sizes[s], s) for s in [0, -1, 1]])
+    axials = np.concatenate([np.arange(sizes[s]) for s in [0, -1, 1]])
+    num_bins = len(segments) * num_views * num_tangential
+    rng = np.random.RandomState(0)
+    bins = rng.randint(0, num_bins, size=100000).astype(np.uint32)
+    prompts = rng.rand(len(bins)) < 0.8
+    words = bins | (prompts.astype(np.uint32) << 30)
+    # time markers are skipped
+    words = np.insert(words, np.arange(0, len(words), 100), 0b100 << 29)
+    filename = (tmp_path / 'listmode.l').as_posix()
+    words.astype('<u4').tofile(filename)
+
+    expected = np.zeros((2, len(segments), num_views, num_tangential))
+    sinograms, rest = np.divmod(bins, num_views * num_tangential)
+    rows = c.get_rows(segments[sinograms], axials[sinograms])
+    np.add.at(expected, (1 - prompts.astype(int), rows, rest // num_tangential, rest % num_tangential), 1)
+
+    prompt_sinograms, delayed_sinograms = listmode_to_sinogram(filename, c, chunk_size=4096)
+    assert prompt_sinograms.dtype == np.float32
+    np.testing.assert_array_equal(prompt_sinograms, expected[0])
+    np.testing.assert_array_equal(delayed_sinograms, expected[1])
+    prompt_sinograms, _ = listmode_to_sinogram(petlink32.read_words(filename), c, dtype=np.uint16)
+    np.testing.assert_array_equal(prompt_sinograms, expected[0])
+
+def test_count_bins(monkeypatch):
+    from odlpet.utils import interfile
+    # small blocks, so that the counts span several of them
+    monkeypatch.setattr(interfile, 'COUNT_BLOCK_BITS', 4)
+    index = np.random.RandomState(0).randint(5, 3000, size=5000).astype(np.int32)
+    counts = np.zeros(3010, dtype=np.uint16)
+    interfile._count_bins(counts, index)
+    np.testing.assert_array_equal(counts, np.bincount(index, minlength=3010))
+    # counts do not wrap around
+    with pytest.raises(OverflowError):
+        interfile._count_bins(counts, np.full(2**16, 7, dtype=np.int32))
+
+def test_listmode_frames(tmp_path):
+    from odlpet.utils.interfile import listmode_to_sinogram
+    c = listmode_compression()
+    shape = (c.get_stir_proj_data_info().get_num_sinograms(), c.num_of_views, c.get_num_tangential())
+    rng = np.random.RandomState(0)
+    words = rng.randint(0, np.prod(shape), size=200000).astype(np.uint32) | (1 << 30)
+    # a time marker every 20 words, 1 ms apart
+    markers = np.arange(0, len(words), 20)
+    words[markers] = (0b100 << 29) | (markers // 20).astype(np.uint32)
+    times = np.repeat(markers // 20, 20)
+    frames = [(0, 1000), (1000, 2500), (3000, 3100), (20000, 30000)]
+    out = ((tmp_path / 'prompts').as_posix(), (tmp_path / 'delayeds').as_posix())
+    prompts, delayeds = listmode_to_sinogram(words, c, chunk_size=4099, frames=frames, out=out)
+    assert isinstance(prompts, np.memmap)
+    assert prompts.shape == (4,) + shape
+    for frame, (start, end) in enumerate(frames):
+        expected, _ = listmode_to_sinogram(words[(times >= start) & (times < end)], c)
+        np.testing.assert_array_equal(prompts[frame], expected)
+    assert not delayeds.any()
+    # the frames are in the files
+    np.testing.assert_array_equal(np.fromfile(out[0], dtype=np.float32).reshape(prompts.shape), prompts)
+    # framing protocol of consecutive frames, in s
+    consecutive, _ = listmode_to_sinogram(words, c, frames='1x1s, 1x1.5s')
+    np.testing.assert_array_equal(consecutive, prompts[:2])
@@ -0,0 +1,86 @@
+import gc
+import os
+
+import pytest
+import numpy as np
+import numpy.testing as nt
+
+from odlpet.scanner.scanner import Scanner
+from odlpet.scanner.compression import Compression
+from odlpet.stir.parallel import project_batch, ParallelProjectionEngine
+
+
+def get_projector(num_subsets=1):
+    c = Compression(Scanner())
+    c.num_of_views = 8
+    c.num_non_arccor_bins = 10
+    c.max_diff_ring = 0
+    return c.get_projector(stir_domain=c.get_stir_domain(zoom=.1),
+                           subset_num=num_subsets-1, num_subsets=num_subsets)
+
+@pytest.mark.parametrize('num_workers, use_threads', [(1, False), (2, False), (2, True)])
+@pytest.mark.parametrize('num_subsets', [1, 2])
+def test_batch(num_workers, use_threads, num_subsets):
+    proj = get_projector(num_subsets)
+    volumes = np.random.rand(3, *proj.domain.shape).astype('float32')
+    projections = project_batch(proj, volumes, num_workers=num_workers, use_threads=use_threads)
+    assert projections.shape == (3,) + proj.range.shape
+    for volume, data in zip(volumes, projections):
+        nt.assert_allclose(data, proj(volume), rtol=1e-5)
+
+    back = project_batch(proj.adjoint, projections, num_workers=num_workers, use_threads=use_threads)
+    for data, volume in zip(projections, back):
+        nt.assert_allclose(volume, proj.adjoint(data), rtol=1e-5)
+
+def test_batch_shape():
+    proj = get_projector()
+    with pytest.raises(ValueError):
+        project_batch(proj, np.zeros((2,) + proj.range.shape))
+
+def test_parallel_projector():
+    """
+    The parallel engine projects and back-projects like the STIR projector.
+    """
+    c = Compression(Scanner())
+    c.num_of_views = 8
+    c.num_non_arccor_bins = 10
+    c.max_diff_ring = 0
+    domain = c.get_stir_domain(zoom=.1)
+    proj = c.get_projector(stir_domain=domain)
+    parallel = c.get_projector(stir_domain=domain, num_workers=2)
+    try:
+        assert parallel.domain == proj.domain
+        assert parallel.range == proj.range
+        x = proj.domain.element(np.random.rand(*proj.domain.shape))
+        nt.assert_allclose(parallel(x), proj(x), rtol=1e-5)
+        y = proj.range.element(np.random.rand(*proj.range.shape))
+        nt.assert_allclose(parallel.adjoint(y), proj.adjoint(y), rtol=1e-4)
+    finally:
+        parallel.close()
+
+def is_running(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    return True
+
+def test_engine_lifetime():
+    proj = get_projector()
+    with pytest.raises(ValueError):
+        ParallelProjectionEngine(proj, num_workers=2, num_parts=proj.range.shape[1] + 1)
+    with ParallelProjectionEngine(proj, num_workers=2) as engine:
+        assert engine.worker_pids == []
+        out = np.empty(proj.range.shape, dtype='float32')
+        engine.forward(np.ones(proj.domain.shape, dtype='float32'), out)
+        pids = engine.worker_pids
+        assert len(pids) == 2
+    assert engine.worker_pids == []
+    assert not any(is_running(pid) for pid in pids)
+    # an engine that is not closed is stopped when garbage collected
+    engine = ParallelProjectionEngine(proj, num_workers=2)
+    engine.pool
+    pids = engine.worker_pids
+    del engine
+    gc.collect()
+    assert not any(is_running(pid) for pid in pids)
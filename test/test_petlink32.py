@@ -0,0 +1,64 @@
+import numpy as np
+import pytest
+
+from odlpet.utils import petlink32 as pl
+
+
+def make_words(num, seed=0):
+    rng = np.random.RandomState(seed)
+    words = rng.randint(0, 2**31, size=num).astype(np.uint32)
+    # time markers, dead time, bed and gating tags between the events
+    kinds = rng.randint(0, 20, size=num)
+    words[kinds == 0] = (0b100 << 29) | np.arange(num, dtype=np.uint32)[kinds == 0]
+    words[kinds == 1] = (0b101 << 29) | (words[kinds == 1] & 0x1fffffff)
+    words[kinds == 2] = (0b11000100 << 24) | (words[kinds == 2] & 0x1fffff)
+    words[kinds == 3] = (0b11000011 << 24) | (words[kinds == 3] & 0x3fff)
+    words[kinds == 4] = (0b11100 << 27) | (words[kinds == 4] & 0xff)
+    return words
+
+
+def decode_per_word(words, time=0):
+    bins, prompts, times, gates = [], [], [], []
+    for word in words.tolist():
+        if pl.ELAPSED_TIME_MARKER.compare(word):
+            time = pl.TIME_MS.evaluate(word)
+        elif pl.EVENT.compare(word):
+            bins.append(pl.BIN_ADDRESS.evaluate(word))
+            prompts.append(pl.PROMPT.compare(word))
+            times.append(time)
+        elif pl.BASIC_GATING.compare(word):
+            gates.append((time, pl.BASIC_GATING_E0_G.evaluate(word)))
+    return bins, prompts, times, gates, time
+
+
+def test_decode():
+    words = make_words(10000)
+    bins, prompts, times, gates, end_time = decode_per_word(words, 7)
+    chunk = pl.decode(words, start_time=7)
+    np.testing.assert_array_equal(chunk.bins, bins)
+    np.testing.assert_array_equal(chunk.prompts, prompts)
+    np.testing.assert_array_equal(chunk.event_times, times)
+    np.testing.assert_array_equal(np.stack(chunk.gating, axis=1), gates)
+    assert chunk.end_time == end_time
+    assert len(chunk.dead_time[0]) == np.sum(words >> 29 == 0b101)
+    assert np.all(chunk.horizontal_bed[1] < 2**20)
+
+
+def test_iter_decode(tmp_path):
+    words = make_words(10000, seed=1)
+    filename = (tmp_path / 'listmode.l').as_posix()
+    words.astype(pl.WORD_DTYPE).tofile(filename)
+    whole = pl.decode(words)
+    chunks = list(pl.iter_decode(filename, chunk_size=999))
+    assert len(chunks) == 11
+    np.testing.assert_array_equal(np.concatenate([c.bins for c in chunks]), whole.bins)
+    np.testing.assert_array_equal(np.concatenate([c.event_times for c in chunks]), whole.event_times)
+    assert chunks[-1].end_time == whole.end_time
+
+
+def test_compare_without_value():
+    assert pl.PROMPT.compare(1 << 30)
+    with pytest.raises(ValueError):
+        pl.BIN_ADDRESS.compare(123)
+    with pytest.raises(ValueError):
+        pl.TIME_MS.compare(np.zeros(3, dtype=pl.WORD_DTYPE))
@@ -0,0 +1,68 @@
+import pickle
+
+import numpy as np
+import numpy.testing as nt
+
+from odlpet.scanner.scanner import mCT, Scanner
+from odlpet.scanner.compression import Compression
+from odlpet.stir.bindings import ForwardProjectorByBinWrapper
+from odlpet.stir.system_matrix import SystemMatrixOperator
+
+
+def small_compression():
+    c = Compression(Scanner())
+    c.num_of_views = 6
+    c.num_non_arccor_bins = 8
+    c.max_diff_ring = 0
+    return c
+
+def test_pickle_compression():
+    c = Compression(mCT())
+    c.span_num = 3
+    c2 = pickle.loads(pickle.dumps(c))
+    assert c2.span_num == 3
+    assert c2.scanner.num_rings == c.scanner.num_rings
+    assert c2.get_stir_proj_data_info().get_num_sinograms() == c.get_stir_proj_data_info().get_num_sinograms()
+
+def test_pickle_projector():
+    c = small_compression()
+    domain = c.get_stir_domain(zoom=.1)
+    proj = c.get_projector(stir_domain=domain)
+    data = pickle.dumps(proj)
+    # only the description is pickled, not the STIR objects
+    assert len(data) < 10000
+    proj2 = pickle.loads(data)
+    assert isinstance(proj2, ForwardProjectorByBinWrapper)
+    assert proj2.domain == proj.domain
+    assert proj2.range == proj.range
+    x = proj.domain.element(np.random.rand(*proj.domain.shape))
+    nt.assert_allclose(proj2(x), proj(x))
+    y = proj.range.element(np.random.rand(*proj.range.shape))
+    nt.assert_allclose(proj2.adjoint(y), proj.adjoint(y))
+    back = pickle.loads(pickle.dumps(proj.adjoint))
+    nt.assert_allclose(back(y), proj.adjoint(y))
+    assert back.adjoint.range == proj.range
+
+def test_pickle_subset_projector():
+    c = small_compression()
+    domain = c.get_stir_domain(zoom=.1)
+    proj = c.get_projector(stir_domain=domain, subset_num=1, num_subsets=2)
+    proj2 = pickle.loads(pickle.dumps(proj))
+    assert proj2.range == proj.range
+    x = proj.domain.element(np.random.rand(*proj.domain.shape))
+    nt.assert_allclose(proj2(x), proj(x))
+
+def test_pickle_cached_projector(tmp_path):
+    c = small_compression()
+    domain = c.get_stir_domain(zoom=.1)
+    cached = c.get_projector(stir_domain=domain, matrix_cache=str(tmp_path))
+    data = pickle.dumps(cached)
+    # the matrix is memory-mapped from the cache again
+    assert len(data) < cached.matrix.data.nbytes
+    cached2 = pickle.loads(data)
+    assert isinstance(cached2, SystemMatrixOperator)
+    x = cached.domain.element(np.random.rand(*cached.domain.shape))
+    nt.assert_allclose(cached2(x), cached(x))
+    back = pickle.loads(pickle.dumps(cached.adjoint))
+    y = cached.range.element(np.random.rand(*cached.range.shape))
+    nt.assert_allclose(back(y), cached.adjoint(y))
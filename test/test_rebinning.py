@@ -0,0 +1,101 @@
+import pytest
+import numpy as np
+import numpy.testing as nt
+
+from odlpet.scanner.scanner import mCT
+from odlpet.scanner.compression import Compression
+from odlpet.scanner.rebinning import (get_span_rebinning, get_view_mashing,
+                                      get_tangential_rebinning, get_tangential_mashing,
+                                      get_projection_space, get_ssrb, get_ssrb_compression)
+
+
+def compression(span, max_diff_ring):
+    c = Compression(mCT())
+    c.span_num = span
+    c.max_diff_ring = max_diff_ring
+    return c
+
+def check_adjoint(op):
+    x = op.domain.element(np.random.rand(*op.domain.shape))
+    y = op.range.element(np.random.rand(*op.range.shape))
+    assert op(x).inner(y) == pytest.approx(x.inner(op.adjoint(y)), rel=1e-4)
+
+def test_span_rebinning():
+    source = compression(1, 4)
+    target = compression(3, 4)
+    op = get_span_rebinning(source, target)
+    x = op.domain.element(np.random.rand(*op.domain.shape))
+    y = op(x)
+    # the total counts are kept
+    assert y.asarray().sum() == pytest.approx(x.asarray().sum(), rel=1e-4)
+    # a span 3 segment 0 sinogram sums the span 1 sinograms of its ring pairs
+    r1, r2, which = target.get_row_ring_pairs([target.get_offset(0, 5)])
+    rows = source.get_ring_pair_rows(r1, r2)
+    nt.assert_allclose(y[target.get_offset(0, 5)], x.asarray()[rows].sum(axis=0), rtol=1e-5)
+    check_adjoint(op)
+
+def test_max_diff_rebinning():
+    source = compression(1, 4)
+    target = compression(1, 2)
+    op = get_span_rebinning(source, target)
+    x = op.domain.element(np.random.rand(*op.domain.shape))
+    nt.assert_allclose(target.get_segment_view(op(x), -2), source.get_segment_view(x, -2))
+
+def test_incompatible_span():
+    with pytest.raises(ValueError):
+        get_span_rebinning(compression(3, 4), compression(1, 4))
+
+def test_view_mashing():
+    source = compression(1, 2)
+    target = compression(1, 2)
+    target.num_of_views = source.num_of_views // 7
+    op = get_view_mashing(source, target)
+    x = op.domain.element(np.random.rand(*op.domain.shape))
+    nt.assert_allclose(op(x)[:, 1], x.asarray()[:, 7:14].sum(axis=1), rtol=1e-5)
+    check_adjoint(op)
+    for num_views in [source.num_of_views // 7 + 1, source.num_of_views // 2]:
+        target.num_of_views = num_views
+        with pytest.raises(ValueError):
+            get_view_mashing(source, target)
+
+def test_tangential_rebinning():
+    source = compression(1, 2)
+    target = compression(1, 2)
+    target.num_non_arccor_bins = source.num_non_arccor_bins - 10
+    op = get_tangential_rebinning(source, target)
+    x = op.domain.element(np.random.rand(*op.domain.shape))
+    nt.assert_allclose(op(x), x.asarray()[:, :, 5:-5])
+    check_adjoint(op)
+    check_adjoint(get_tangential_rebinning(target, source))
+
+def test_tangential_mashing():
+    source = compression(1, 2)
+    space = get_projection_space(source)
+    op = get_tangential_mashing(space, 2)
+    x = space.element(np.random.rand(*space.shape))
+    nt.assert_allclose(op(x)[:, :, 3], x.asarray()[:, :, 6:8].sum(axis=2), rtol=1e-5)
+    check_adjoint(op)
+
+def test_ssrb():
+    source = compression(1, 3)
+    op = get_ssrb(source)
+    target = get_ssrb_compression(source)
+    assert op.range.shape[0] == 2*source.scanner.num_rings - 1
+    assert [s for s, _ in target._get_sinogram_info()] == [0]
+    # uniform ring pairs give each direct sinogram its own number of ring pairs
+    y = op(op.domain.one())
+    _, _, which = target.get_row_ring_pairs(np.arange(op.range.shape[0]))
+    nt.assert_allclose(y.asarray()[:, 0, 0], np.bincount(which), rtol=1e-5)
+    check_adjoint(op)
+    # with span 3, a source sinogram holds the sum of its ring pairs
+    source = compression(3, 4)
+    op = get_ssrb(source)
+    _, _, which = source.get_row_ring_pairs(np.arange(op.domain.shape[0]))
+    x = np.broadcast_to(np.bincount(which)[:, None, None], op.domain.shape)
+    y = op(op.domain.element(x))
+    _, _, which = target.get_row_ring_pairs(np.arange(op.range.shape[0]))
+    nt.assert_allclose(y.asarray()[:, 0, 0], np.bincount(which), rtol=1e-5)
+    check_adjoint(op)
+    # the 2D projector has the rebinned range
+    domain = source.get_stir_domain(zoom=.1)
+    assert target.get_projector(stir_domain=domain).range == op.range
@@ -0,0 +1,66 @@
+import numpy as np
+import numpy.testing as nt
+
+from odlpet.scanner.scanner import Scanner
+from odlpet.scanner.compression import Compression
+from odlpet.stir.reconstruction import osem, mlem, SensitivityCache, EPS
+
+
+def small_compression():
+    c = Compression(Scanner())
+    c.num_of_views = 6
+    c.num_non_arccor_bins = 8
+    c.max_diff_ring = 0
+    return c
+
+def test_osem_matches_odl_update():
+    c = small_compression()
+    projs, slicings = c.get_projectors(num_subsets=2, stir_domain=c.get_stir_domain(zoom=.1))
+    full_data = slicings[0].domain.element(np.random.rand(*slicings[0].domain.shape))
+    data = [s(full_data) for s in slicings]
+
+    expected = projs[0].domain.one()
+    for proj, d in zip(projs, data):
+        sens = np.maximum(proj.adjoint(proj.range.one()).asarray(), EPS)
+        ratio = d.asarray() / np.maximum(proj(expected).asarray(), EPS)
+        expected = expected * proj.adjoint(ratio).asarray() / sens
+
+    x = projs[0].domain.one()
+    reports = []
+    osem(projs, x, data, niter=1, report=reports.append)
+    nt.assert_allclose(x.asarray(), expected.asarray(), rtol=1e-4)
+    assert len(reports) == 1
+    assert len(reports[0]['subset_times']) == 2
+    assert reports[0]['time'] > 0
+
+def test_sensitivity_cache(tmp_path):
+    c = small_compression()
+    proj = c.get_projector(stir_domain=c.get_stir_domain(zoom=.1))
+    data = proj(proj.domain.one())
+    x = proj.domain.one()
+    mlem(proj, x, data, niter=1, sensitivity_cache=str(tmp_path))
+    assert len(list(tmp_path.glob('*.npy'))) == 1
+    # a new cache on the same directory loads the stored image
+    cache = SensitivityCache(str(tmp_path))
+    x2 = proj.domain.one()
+    mlem(proj, x2, data, niter=1, sensitivity_cache=cache)
+    assert len(cache.images) == 1
+    nt.assert_allclose(x2.asarray(), x.asarray())
+
+def test_reconstruct_planes():
+    from odlpet.scanner.scanner import mCT
+    from odlpet.scanner.rebinning import get_ssrb_compression
+    from odlpet.stir.reconstruction import reconstruct_planes
+    c = Compression(mCT())
+    c.num_of_views = 14
+    c.num_non_arccor_bins = 20
+    target = get_ssrb_compression(c)
+    domain = target.get_stir_domain(zoom=.2)
+    proj = target.get_projector(stir_domain=domain)
+    data = proj(proj.domain.one())
+    serial = reconstruct_planes(target, data, niter=2, stir_domain=domain, num_subsets=2)
+    assert serial.space == proj.domain
+    assert np.all(np.isfinite(serial.asarray()))
+    parallel = reconstruct_planes(target, data, niter=2, stir_domain=domain,
+                                  num_subsets=2, num_workers=2)
+    nt.assert_allclose(parallel.asarray(), serial.asarray(), rtol=1e-5)
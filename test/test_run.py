@@ -14,3 +14,41 @@ def test_simple_run():
     compression = Compression(Scanner())
     proj = compression.get_projector(stir_domain=compression.get_stir_domain(zoom=.1))
     result = proj(proj.domain.one())
+
+def test_read_into_out():
+    """
+    Projections are read from STIR directly into the given output element.
+    """
+    import numpy as np
+    import stirextra
+    compression = Compression(Scanner())
+    compression.num_of_views = 8
+    compression.num_non_arccor_bins = 10
+    proj = compression.get_projector(stir_domain=compression.get_stir_domain(zoom=.1))
+    out = proj.range.element()
+    result = proj(proj.domain.one(), out=out)
+    assert result is out
+    np.testing.assert_array_equal(out.asarray(), stirextra.to_numpy(proj.proj_data))
+    back = proj.adjoint(out)
+    np.testing.assert_array_equal(back.asarray(), stirextra.to_numpy(proj.volume))
+
+def test_normal_operator():
+    """
+    The normal operator matches a forward then a back projection.
+    """
+    import numpy as np
+    from odlpet.stir.bindings import NormalProjectorByBinWrapper
+    compression = Compression(Scanner())
+    compression.num_of_views = 8
+    compression.num_non_arccor_bins = 10
+    domain = compression.get_stir_domain(zoom=.1)
+    for proj in [compression.get_projector(stir_domain=domain),
+                 compression.get_projector(stir_domain=domain, subset_num=1, num_subsets=2)]:
+        normal = NormalProjectorByBinWrapper(proj)
+        x = proj.domain.element(np.random.rand(*proj.domain.shape))
+        expected = proj.adjoint(proj(x))
+        out = proj.domain.element()
+        result = normal(x, out=out)
+        assert result is out
+        np.testing.assert_allclose(out.asarray(), expected.asarray(), rtol=1e-5)
+        assert normal.adjoint is normal
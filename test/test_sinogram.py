@@ -61,3 +61,60 @@ def test_shape():
     projdata = stir.ProjDataInMemory(stir.ExamInfo(), projdatainfo)
     shape = get_shape_from_proj_data(projdata)
     assert shape == projdata.to_array().shape()
+
+@pytest.mark.parametrize('span', [1, 3])
+def test_vectorized_rows(span):
+    compression = Compression(mCT())
+    compression.span_num = span
+    compression.max_diff_ring = 4 if span == 3 else 3
+    sinfo = compression._get_sinogram_info()
+    segments = np.array([s for (s, size) in sinfo for a in range(size)])
+    axials = np.array([a for (s, size) in sinfo for a in range(size)])
+    rows = compression.get_rows(segments, axials)
+    expected = [compression.get_offset(s, a) for (s, a) in zip(segments, axials)]
+    np.testing.assert_array_equal(rows, expected)
+    seg, ax = compression.get_segment_axial(rows)
+    np.testing.assert_array_equal(seg, segments)
+    np.testing.assert_array_equal(ax, axials)
+    with pytest.raises(ValueError):
+        compression.get_rows([0], [sinfo[len(sinfo)//2][1]])
+
+def test_ring_pairs():
+    """
+    Ring pairs map to the sinograms STIR assigns them.
+    """
+    compression = Compression(mCT())
+    compression.span_num = 3
+    compression.max_diff_ring = 4
+    info = compression.get_stir_proj_data_info()
+    rings = np.arange(compression.scanner.num_rings)
+    ring1, ring2 = [r.ravel() for r in np.meshgrid(rings, rings)]
+    rows = compression.get_ring_pair_rows(ring1, ring2)
+    assert np.all((rows >= 0) == (np.abs(ring2 - ring1) <= 4))
+    r1, r2, which = compression.get_row_ring_pairs(np.arange(info.get_num_sinograms()))
+    assert len(r1) == np.sum(rows >= 0)
+    np.testing.assert_array_equal(compression.get_ring_pair_rows(r1, r2), which)
+    # each segment 0 sinogram of span 3 has one or two ring pairs
+    seg, _ = compression.get_segment_axial(which)
+    assert set(np.bincount(which[seg == 0])) <= {1, 2}
+
+def test_segment_views():
+    compression = Compression(mCT())
+    compression.max_diff_ring = 2
+    proj = compression.get_projector(stir_domain=compression.get_stir_domain(zoom=.1))
+    projections = proj.range.element(np.random.rand(*proj.range.shape))
+    sinfo = compression._get_sinogram_info()
+    view = compression.get_segment_view(projections, -1)
+    assert view.shape[0] == dict(sinfo)[-1]
+    offset = compression.get_offset(-1, 0)
+    np.testing.assert_array_equal(view, projections.asarray()[offset:offset+len(view)])
+    # no copy
+    view[:] = 0
+    assert np.all(projections.asarray()[offset:offset+len(view)] == 0)
+    central = compression.get_segment_view(projections, [0, 1, -1])
+    assert central.shape[0] == sum(dict(sinfo)[s] for s in [0, 1, -1])
+    with pytest.raises(ValueError):
+        compression.get_segment_view(projections, [0, -1])
+    segments = [segment for segment, _ in compression.iter_segments(projections)]
+    assert segments == [0, 1, -1, 2, -2]
+    assert sum(len(v) for _, v in compression.iter_segments(projections)) == proj.range.shape[0]
@@ -0,0 +1,63 @@
+import os
+import shutil
+from pathlib import Path
+
+import pytest
+
+from odlpet.utils.study_index import StudyIndex
+
+base = Path(__file__).parent.parent / 'examples' / 'data' / 'stir'
+
+
+def test_study_index(tmp_path):
+    studies = tmp_path / 'studies'
+    (studies / 'patient').mkdir(parents=True)
+    for name in ['FDG_g1.hv', 'FDG_g1.v', 'my_prompts_g1.hs', 'my_prompts_g1.s']:
+        shutil.copy((base / name).as_posix(), (studies / 'patient' / name).as_posix())
+    filename = (tmp_path / 'index.sqlite').as_posix()
+    with StudyIndex(filename) as index:
+        assert index.update(studies.as_posix()) == 2
+        # nothing changed
+        assert index.update(studies.as_posix()) == 0
+        [prompts] = index.find(scanner='ecat 931')
+        assert prompts['kind'] == '.hs'
+        assert prompts['data_bytes'] == os.path.getsize((base / 'my_prompts_g1.s').as_posix())
+        [image] = index.find(kind='.hv')
+        assert image['matrix_size'] == [155, 155, 15]
+        assert image['num_frames'] == 1
+        assert prompts in index.find(min_bytes=prompts['data_bytes'])
+        assert not index.find(scanner='ecat', min_bytes=10**9)
+
+    header = studies / 'patient' / 'FDG_g1.hv'
+    header.write_text(header.read_text().replace('number of time frames := 1',
+                                                 'number of time frames := 1\nimage duration (sec)[1] := 600'))
+    os.utime(header.as_posix(), ns=(0, 1))
+    (studies / 'patient' / 'my_prompts_g1.hs').unlink()
+    # the index is kept on disk between runs
+    with StudyIndex(filename) as index:
+        assert index.update(studies.as_posix()) == 1
+        [image] = index.query('duration > ?', (60,))
+        assert image['duration'] == 600
+        assert not index.find(kind='.hs')
+
+
+def test_broken_headers(tmp_path):
+    studies = tmp_path / 'studies'
+    studies.mkdir()
+    for name in ['FDG_g1.hv', 'FDG_g1.v']:
+        shutil.copy((base / name).as_posix(), (studies / name).as_posix())
+    (studies / 'broken.hv').write_text('!INTERFILE :=\nname of data file broken.v\n')
+    (studies / 'binary.l.hdr').write_bytes(bytes(range(128, 256)))
+    with StudyIndex((tmp_path / 'index.sqlite').as_posix()) as index:
+        with pytest.warns(UserWarning):
+            assert index.update(studies.as_posix()) == 3
+        assert [r['path'] for r in index.query()] == [(studies / 'FDG_g1.hv').as_posix()]
+        assert [path for (path, _) in index.errors()] == [
+            (studies / 'binary.l.hdr').as_posix(), (studies / 'broken.hv').as_posix()]
+        # the broken headers are only parsed again once modified
+        assert index.update(studies.as_posix()) == 0
+        (studies / 'broken.hv').write_text('!INTERFILE :=\nname of data file := broken.v\n')
+        os.utime((studies / 'broken.hv').as_posix(), ns=(0, 1))
+        assert index.update(studies.as_posix()) == 1
+        assert len(index.query()) == 2
+        assert len(index.errors()) == 1
@@ -0,0 +1,95 @@
+import time
+
+import pytest
+import numpy as np
+import numpy.testing as nt
+import scipy.sparse
+
+from odlpet.scanner.scanner import Scanner
+from odlpet.scanner.compression import Compression
+from odlpet.stir.system_matrix import SystemMatrixCache, SystemMatrixOperator
+
+
+def random_matrix(shape=(20, 30)):
+    matrix = scipy.sparse.random(*shape, density=.2, format='csr', dtype=np.float32)
+    matrix.indices = matrix.indices.astype(np.int32)
+    matrix.indptr = matrix.indptr.astype(np.int32)
+    return matrix
+
+def test_cache_roundtrip(tmp_path):
+    cache = SystemMatrixCache(str(tmp_path))
+    matrix = random_matrix()
+    stored = cache.get('key', lambda: matrix)
+    loaded = cache.get('key', lambda: pytest.fail("matrix should be cached"))
+    assert abs(stored - matrix).max() == 0
+    assert abs(loaded - matrix).max() == 0
+
+def test_cache_eviction(tmp_path):
+    matrix = random_matrix()
+    cache = SystemMatrixCache(str(tmp_path))
+    cache.store('first', matrix)
+    one_size = cache.size()
+    cache.max_bytes = 2*one_size
+    time.sleep(.01)
+    cache.store('second', matrix)
+    time.sleep(.01)
+    cache.load('first') # most recently used
+    time.sleep(.01)
+    cache.store('third', matrix)
+    assert cache.load('second') is None
+    assert cache.load('first') is not None
+    assert cache.load('third') is not None
+
+def test_cached_projector(tmp_path):
+    """
+    The cached system matrix projects like the STIR projector.
+    """
+    c = Compression(Scanner())
+    c.num_of_views = 6
+    c.num_non_arccor_bins = 8
+    c.max_diff_ring = 0
+    domain = c.get_stir_domain(zoom=.1)
+    proj = c.get_projector(stir_domain=domain)
+    cached = c.get_projector(stir_domain=domain, matrix_cache=str(tmp_path))
+    assert isinstance(cached, SystemMatrixOperator)
+    assert cached.domain == proj.domain
+    assert cached.range == proj.range
+    x = proj.domain.element(np.random.rand(*proj.domain.shape))
+    nt.assert_allclose(cached(x), proj(x), rtol=1e-4, atol=1e-4)
+    y = proj.range.element(np.random.rand(*proj.range.shape))
+    nt.assert_allclose(cached.adjoint(y), proj.adjoint(y), rtol=1e-4, atol=1e-4)
+
+def test_matrix_selection():
+    """
+    Rows computed for some segments and a subset are those of the full matrix.
+    """
+    c = Compression(Scanner())
+    c.num_of_views = 6
+    c.num_non_arccor_bins = 8
+    c.max_diff_ring = 1
+    domain = c.get_stir_domain(zoom=.1)
+    full = c.get_system_matrix(stir_domain=domain)
+    info = c._get_sinogram_info()
+    num_views = c.get_stir_proj_data_info().get_num_views()
+    num_tang = c.get_stir_proj_data_info().get_num_tangential_poss()
+    shape = (full.shape[0] // (num_views * num_tang), num_views, num_tang)
+    part = c.get_system_matrix(stir_domain=domain, segments=[1], subset_num=1, num_subsets=2)
+    start = c.get_offset(1, 0)
+    rows = np.arange(full.shape[0]).reshape(shape)[start:start+dict(info)[1], 1::2]
+    assert abs(part - full[rows.ravel()]).max() == 0
+
+def test_apply_batch():
+    c = Compression(Scanner())
+    c.num_of_views = 6
+    c.num_non_arccor_bins = 8
+    c.max_diff_ring = 0
+    domain = c.get_stir_domain(zoom=.1)
+    op = c.get_matrix_projector(stir_domain=domain)
+    assert op.range == c.get_projector(stir_domain=domain).range
+    inputs = np.random.rand(3, *op.domain.shape)
+    for num_threads in [1, 2]:
+        out = op.apply_batch(inputs, num_threads=num_threads)
+        for x, y in zip(inputs, out):
+            nt.assert_allclose(y, op(x), rtol=1e-5)
+    back = op.adjoint.apply_batch(out)
+    nt.assert_allclose(back[0], op.adjoint(out[0]), rtol=1e-5)